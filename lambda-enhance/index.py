@@ -20,9 +20,40 @@ import boto3
 import csv
 import array
 import os
+import time
+
+fhclient = boto3.client('firehose')
+
+# Firehose PutRecordBatch limits
+max_batch_records = 500
+max_batch_bytes = 4 * 1024 * 1024
+
+# Attempts at delivering entries that Firehose rejects, with exponential backoff
+max_put_attempts = 5
+retry_base_seconds = 0.1
+
+def put_batch(records):
+    """Deliver the records with PutRecordBatch, resending only the entries that failed."""
+    attempt = 1
+    while True:
+        fhresponse = fhclient.put_record_batch(
+            DeliveryStreamName=os.environ['DeliveryStreamName'],
+            Records=[{'Data': data} for data in records]
+        )
+        print("Sent {0} records to Firehose, {1} failed".format(len(records), fhresponse['FailedPutCount']))
+        if fhresponse['FailedPutCount'] == 0:
+            return
+        records = [data for data, result in zip(records, fhresponse['RequestResponses']) if 'ErrorCode' in result]
+        if attempt == max_put_attempts:
+            # Failing the invocation makes Lambda retry the Kinesis batch, as a failed put_record used to.
+            raise Exception("Firehose rejected {0} records after {1} attempts".format(len(records), attempt))
+        time.sleep(retry_base_seconds * (2 ** attempt))
+        attempt = attempt + 1
 
 def handler(event, context):
     bad_records = []
+    batch = []
+    batch_bytes = 0
     for record in event['Records']:
         # Kinesis data is base64 encoded so decode here
         payload = base64.b64decode(record['kinesis']['data'])
@@ -46,14 +77,16 @@ def handler(event, context):
         # Translate user name to an encoded ID.  We'll just use a simple encoding here.
         uid = base64.b64encode(user)
 
-        # publish to firehose
-        fhclient = boto3.client('firehose')
+        # buffer for firehose, sending a batch whenever the next record wouldn't fit
         fhrecord = "{0},{1},{2},{3},{4},{5},{6}\n".format(uid, ad, countrycode, category, product, timestamp, rating)
-        fhresponse = fhclient.put_record(
-            DeliveryStreamName=os.environ['DeliveryStreamName'],
-            Record={
-                'Data': fhrecord.encode('utf-8')
-            }
-        )
-        print("Response from Firehose: {0}".format(fhresponse))
+        data = fhrecord.encode('utf-8')
+        if len(batch) == max_batch_records or batch_bytes + len(data) > max_batch_bytes:
+            put_batch(batch)
+            batch = []
+            batch_bytes = 0
+        batch.append(data)
+        batch_bytes = batch_bytes + len(data)
+
+    if len(batch) > 0:
+        put_batch(batch)
     return 'Processed {0} records, with {1} failures.'.format(len(event['Records']), len(bad_records))
@@ -23,6 +23,12 @@ import os
 import copy
 import time
 import traceback
+import threading
+from collections import OrderedDict
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 
 ad_map = {
     '0f2fcf95319f5c1e5745371351f521e5': "Free Shipping",
@@ -70,90 +76,261 @@ prod_map = {
     '0708f809769d6eb4f49d3f6cf6c09e69c754f1337a21b0d5d5a0d0f2c712271e': 'Flip flops'
 }
 
+sagemaker_runtime = boto3.client('sagemaker-runtime')
+snsclient = boto3.client('sns')
+fhclient = boto3.client('firehose')
+
+# Most clicks scored in one call to the endpoint
+max_clicks_per_request = int(os.environ.get('MaxClicksPerRequest', '50'))
+
+# Most endpoint calls or SNS notifications in flight at once
+max_concurrent_calls = int(os.environ.get('MaxConcurrentCalls', '8'))
+
+# Firehose PutRecordBatch limits
+max_batch_records = 500
+max_batch_bytes = 4 * 1024 * 1024
+
+# Attempts at delivering entries that Firehose rejects, with exponential backoff
+max_put_attempts = 5
+retry_base_seconds = 0.1
+
+# Best offers are remembered per (user, country, category, product) for a while, so
+# repeated clicks in the same warm container don't go back to the endpoint
+cache_ttl_seconds = float(os.environ.get('CacheTtlSeconds', '300'))
+cache_max_entries = int(os.environ.get('CacheMaxEntries', '10000'))
+
+class OfferCache(object):
+    """Least recently used cache of (offer, score) pairs that expire after a TTL.
+
+    Everything is dropped when the endpoint name changes, as a new endpoint usually
+    means a new model."""
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.endpoint = None
+        self.hits = 0
+        self.misses = 0
+
+    def check_endpoint(self, endpoint):
+        if endpoint != self.endpoint:
+            if self.endpoint is not None:
+                print("Endpoint changed from {0} to {1}, clearing {2} cached offers".format(self.endpoint, endpoint, len(self.entries)))
+            self.entries.clear()
+            self.endpoint = endpoint
+
+    def get(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None or entry[0] < time.time():
+            self.misses = self.misses + 1
+            return None
+        self.entries[key] = entry
+        self.hits = self.hits + 1
+        return entry[1]
+
+    def put(self, key, value):
+        if self.max_entries <= 0 or self.ttl <= 0:
+            return
+        self.entries.pop(key, None)
+        self.entries[key] = (time.time() + self.ttl, value)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+offer_cache = OfferCache(cache_ttl_seconds, cache_max_entries)
+
+def cache_key(click):
+    return (click['uid'], click['countrycode'], click['category'], click['product'])
+
+def run_concurrently(fn, items):
+    """Call fn on every item from a bounded pool of threads.
+
+    Returns a (result, error) pair per item, in order, where error is a description of
+    the exception fn raised or None."""
+    results = [None] * len(items)
+    work = queue.Queue()
+    for idx, item in enumerate(items):
+        work.put((idx, item))
+
+    def worker():
+        while True:
+            try:
+                idx, item = work.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results[idx] = (fn(item), None)
+            except Exception as e:
+                results[idx] = (None, "{0}: {1}".format(str(e), traceback.format_exc()))
+
+    threads = [threading.Thread(target=worker) for _ in range(min(max_concurrent_calls, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def put_batch(records):
+    """Deliver the records with PutRecordBatch, resending only the entries that failed.
+
+    Returns the positions of the records that still failed after the last attempt."""
+    pending = list(range(len(records)))
+    attempt = 1
+    while True:
+        fhresponse = fhclient.put_record_batch(
+            DeliveryStreamName=os.environ['DeliveryStreamName'],
+            Records=[{'Data': records[idx]} for idx in pending]
+        )
+        print("Sent {0} records to Firehose, {1} failed".format(len(pending), fhresponse['FailedPutCount']))
+        if fhresponse['FailedPutCount'] == 0:
+            return []
+        pending = [idx for idx, result in zip(pending, fhresponse['RequestResponses']) if 'ErrorCode' in result]
+        if attempt == max_put_attempts:
+            return pending
+        time.sleep(retry_base_seconds * (2 ** attempt))
+        attempt = attempt + 1
+
+def put_records(records):
+    """Deliver the records to Firehose in as few batches as the limits allow.
+
+    Returns the positions of the records that could not be delivered."""
+    failed = []
+    start = 0
+    while start < len(records):
+        end = start
+        batch_bytes = 0
+        while end < len(records) and end - start < max_batch_records and batch_bytes + len(records[end]) <= max_batch_bytes:
+            batch_bytes = batch_bytes + len(records[end])
+            end = end + 1
+        failed.extend(start + idx for idx in put_batch(records[start:end]))
+        start = end
+    return failed
+
+def notify(scored):
+    click, selected_ad, max_score = scored
+    print("Best response score: {0}".format(max_score))
+    print("Best ad: {0}".format(selected_ad))
+
+    snsresponse = snsclient.publish(
+        TopicArn=os.environ['SnsTopic'],
+        Message="We noticed you were looking at our {2} today.  We thought that a discount might make your decision easier - {0}! Enter code {1} on the checkout page.".format(ad_map[selected_ad], selected_ad, prod_map[click['product']]),
+        Subject="You have a coupon!"
+    )
+    print("Response from SNS: {0}".format(snsresponse))
+
+def score_clicks(clicks):
+    """Ask the model for the best offer for each click, in a single endpoint call.
+
+    Returns a (offer, score) pair per click, in order."""
+
+    # Convert to json.  Each user's features are sent once as a context, and every
+    # context is scored against each offer as a candidate.  We only need the best offer back.
+    offers = list(ad_map.keys())
+    js = {
+        'contexts': [],
+        'candidates': {'keys': ["offerid"], 'values': [[adkey] for adkey in offers]},
+        'top_k': 1
+    }
+    for click in clicks:
+        js['contexts'].append({'keys': ["userid","countrycode","category","product"], 'values': [click['uid'],click['countrycode'],click['category'],click['product']]})
+    model_input = json.dumps(js)
+
+    # invoke model
+    response = sagemaker_runtime.invoke_endpoint(
+        EndpointName = os.environ['EndpointName'],
+        Body=model_input.encode('utf-8'),
+        ContentType='application/json',
+        Accept='application/json'
+    )
+
+    res_json = json.loads(response['Body'].read().decode("utf-8"))
+
+    print("Got model response {0}".format(res_json))
+    best = []
+    for result in res_json['results']:
+        prediction = result['predictions'][0]
+        best.append((offers[prediction['index']], prediction['score']))
+    return best
+
 def handler(event, context):
     bad_records = []
+    clicks = []
     for record in event['Records']:
         # Kinesis data is base64 encoded so decode here
         payload = base64.b64decode(record['kinesis']['data'])
         print("Decoded payload: " + payload)
 
-        # Make sure we don't error out, as that will result in retries
-        try:
-            # Each line is a CSV in format: userid	offerid	countrycode	category	merchant	utcdate	rating
-            # 'edward' c5f63750c2b5b0166e55511ee878b7a3	de	100020213	f3c93baa0cf4430849611cedb3a40ec4094d1d370be8417181da5d13ac99ef3d	2016-06-14 17:28:47.0	0
-            fields = payload.split(',')
-            if len(fields) != 7:
-                bad_records.append(payload)
-                print("Invalid record (need 7 fields): {0}".format(payload))
-                continue
-            user = fields[0]
-            ad = fields[1]
-            countrycode = fields[2]
-            category = fields[3]
-            product = fields[4]
-            timestamp = fields[5]
-            rating = fields[6]
-
-            # Assemble input.  We're going to need a matrix with a float value for every column.
-            uid = base64.b64encode(user)
-
-            # Convert to json
-            js = {'instances': []}
-            ad_idx = {}
-            idx = 0
-            for adkey in ad_map.keys():
-                js['instances'].append({'keys': ["userid","offerid","countrycode","category","product"], 'values': [uid,adkey,countrycode,category,product]})
-                ad_idx[str(idx)] = adkey
-                idx = idx + 1
-            model_input = json.dumps(js)
-
-            # invoke model
-            client = boto3.client('sagemaker-runtime')
-            response = client.invoke_endpoint(
-                EndpointName = os.environ['EndpointName'],
-                Body=model_input.encode('utf-8'),
-                ContentType='application/json',
-                Accept='application/json'
-            )
-
-            res_json = json.loads(response['Body'].read().decode("utf-8"))
-
-            print("Got model response {0}".format(res_json))
-            idx = 0
-            max_score = -2.0
-            selected_ad = '0'
-            for prediction in res_json['predictions']:
-                score = prediction['score']
-                if score > max_score:
-                    max_score = score
-                    selected_ad = ad_idx[str(idx)]
-                idx = idx + 1
-
-            print("Best response score: {0}".format(max_score))
-            print("Best ad: {0}".format(selected_ad))
-
-            # Notify users
-            snsclient = boto3.client('sns')
-            snsresponse = snsclient.publish(
-                TopicArn=os.environ['SnsTopic'],
-                Message="We noticed you were looking at our {2} today.  We thought that a discount might make your decision easier - {0}! Enter code {1} on the checkout page.".format(ad_map[selected_ad], selected_ad, prod_map[product]),
-                Subject="You have a coupon!"
-            )
-            print("Response from SNS: {0}".format(snsresponse))
-
-            # publish to firehose
-            # Each line is a CSV in format: userid	offerid	countrycode	category	merchant	utcdate	
-            fhclient = boto3.client('firehose')
-            fhrecord = "{0},{1},{2},{3},{4},{5},{6}\n".format(uid, selected_ad, countrycode, category, product, time.time(), timestamp)
-            fhresponse = fhclient.put_record(
-                DeliveryStreamName=os.environ['DeliveryStreamName'],
-                Record={
-                    'Data': fhrecord.encode('utf-8')
-                }
-            )
-            print("Response from Firehose: {0}".format(fhresponse))
-        except Exception as e:
-            trc = traceback.format_exc()
-            bad_records.append("{0}: {1}: {2}".format(payload, str(e), trc))
+        # Each line is a CSV in format: userid	offerid	countrycode	category	merchant	utcdate	rating
+        # 'edward' c5f63750c2b5b0166e55511ee878b7a3	de	100020213	f3c93baa0cf4430849611cedb3a40ec4094d1d370be8417181da5d13ac99ef3d	2016-06-14 17:28:47.0	0
+        fields = payload.split(',')
+        if len(fields) != 7:
+            bad_records.append(payload)
+            print("Invalid record (need 7 fields): {0}".format(payload))
+            continue
+        clicks.append({
+            'payload': payload,
+            # We're going to need a matrix with a float value for every column.
+            'uid': base64.b64encode(fields[0]),
+            'countrycode': fields[2],
+            'category': fields[3],
+            'product': fields[4],
+            'timestamp': fields[5]
+        })
+
+    # Use the cached offer for contexts we've scored recently
+    offer_cache.check_endpoint(os.environ['EndpointName'])
+    scored = []
+    uncached = OrderedDict()
+    for click in clicks:
+        key = cache_key(click)
+        if key in uncached:
+            # Already being scored for an earlier click in this batch, which counts as a hit
+            uncached[key].append(click)
+            offer_cache.hits = offer_cache.hits + 1
+            continue
+        best = offer_cache.get(key)
+        if best is None:
+            uncached[key] = [click]
+        else:
+            scored.append((click, best[0], best[1]))
+
+    # Score each remaining context once, with as few endpoint calls as possible, running
+    # the calls side by side.  Make sure we don't error out, as that will result in retries.
+    keys = list(uncached.keys())
+    batches = [keys[start:start + max_clicks_per_request] for start in range(0, len(keys), max_clicks_per_request)]
+    contexts = [[uncached[key][0] for key in batch] for batch in batches]
+    for batch, (best, error) in zip(batches, run_concurrently(score_clicks, contexts)):
+        for key, result in zip(batch, best if error is None else [None] * len(batch)):
+            if result is not None:
+                offer_cache.put(key, result)
+            for click in uncached[key]:
+                if result is None:
+                    bad_records.append("{0}: {1}".format(click['payload'], error))
+                else:
+                    scored.append((click, result[0], result[1]))
+    print("Offer cache: {0} entries, {1} hits, {2} misses since the container started".format(
+        len(offer_cache.entries), offer_cache.hits, offer_cache.misses))
+
+    # Notify users, several at a time
+    notified = []
+    for item, (_, error) in zip(scored, run_concurrently(notify, scored)):
+        if error is not None:
+            bad_records.append("{0}: {1}".format(item[0]['payload'], error))
+        else:
+            notified.append(item)
+
+    # publish to firehose in batches
+    # Each line is a CSV in format: userid	offerid	countrycode	category	merchant	utcdate	
+    fhrecords = []
+    for click, selected_ad, max_score in notified:
+        fhrecord = "{0},{1},{2},{3},{4},{5},{6}\n".format(click['uid'], selected_ad, click['countrycode'], click['category'], click['product'], time.time(), click['timestamp'])
+        fhrecords.append(fhrecord.encode('utf-8'))
+    try:
+        for idx in put_records(fhrecords):
+            bad_records.append("{0}: Firehose rejected the record".format(notified[idx][0]['payload']))
+    except Exception as e:
+        trc = traceback.format_exc()
+        for click, selected_ad, max_score in notified:
+            bad_records.append("{0}: {1}: {2}".format(click['payload'], str(e), trc))
 
     return 'Processed {0} records, with {1} failures: {2}'.format(len(event['Records']), len(bad_records), "\n".join(bad_records))
@@ -22,6 +22,7 @@ import array
 import os
 import traceback
 import re
+import time
 
 table = os.environ['PartitionFor']
 databaseName = os.environ['DatabaseName']
@@ -32,10 +33,144 @@ ddbclient = boto3.client('dynamodb')
 ddbstreams = os.environ['DdbStreams']
 allowed_streams = ddbstreams.split(',')
 
+# DynamoDB limit on items per BatchWriteItem call
+max_items_per_write = 25
+
+# Attempts at writing items DynamoDB leaves unprocessed, with exponential backoff
+max_write_attempts = 5
+retry_base_seconds = 0.1
+
+# Glue limits on partitions per BatchGetPartition and BatchCreatePartition call
+max_partitions_per_get = 1000
+max_partitions_per_create = 100
+
+# The table descriptor and the partitions we know exist are kept for the life of the
+# container, so files landing in an hour we've already seen cost no Glue calls.
+table_descriptor = None
+known_partitions = set()
+
+def get_table_descriptor():
+    global table_descriptor
+    if table_descriptor is None:
+        table_descriptor = client.get_table(
+            DatabaseName=databaseName,
+            Name=table
+        )['Table']
+    return table_descriptor
+
+def find_existing_partitions(partitions):
+    """Return the set of partitions, as (year, month, day, hour) tuples, that exist in Glue."""
+    existing = set()
+    for start in range(0, len(partitions), max_partitions_per_get):
+        response = client.batch_get_partition(
+            DatabaseName=databaseName,
+            TableName=table,
+            PartitionsToGet=[{'Values': list(values)} for values in partitions[start:start + max_partitions_per_get]]
+        )
+        for partition in response['Partitions']:
+            existing.add(tuple(partition['Values']))
+        if len(response.get('UnprocessedKeys', [])) > 0:
+            print("Glue did not look up {0} partitions, will try to create them".format(len(response['UnprocessedKeys'])))
+    return existing
+
+def partition_input(tbl, values):
+    sdescriptor = tbl['StorageDescriptor']
+    return {
+        'Values': list(values),
+        'StorageDescriptor': {
+            'Columns': sdescriptor['Columns'],
+            'Location': "{0}/{1}/".format(sdescriptor['Location'], "/".join(values)),
+            'InputFormat': sdescriptor['InputFormat'],
+            'OutputFormat': sdescriptor['OutputFormat'],
+            'Compressed': True,
+            'SerdeInfo': sdescriptor['SerdeInfo'],
+            'Parameters': sdescriptor['Parameters'],
+            'StoredAsSubDirectories': False
+        },
+        'Parameters': tbl['Parameters']
+    }
+
+def create_partitions(partitions):
+    """Create the partitions in as few calls as possible, returning the ones that failed.
+
+    Partitions created by someone else in the meantime count as created."""
+    tbl = get_table_descriptor()
+    failed = []
+    for start in range(0, len(partitions), max_partitions_per_create):
+        batch = partitions[start:start + max_partitions_per_create]
+        response = client.batch_create_partition(
+            DatabaseName=databaseName,
+            TableName=table,
+            PartitionInputList=[partition_input(tbl, values) for values in batch]
+        )
+        errors = {}
+        for error in response.get('Errors', []):
+            if error['ErrorDetail']['ErrorCode'] != 'AlreadyExistsException':
+                errors[tuple(error['PartitionValues'])] = error['ErrorDetail']
+        for values in batch:
+            if values in errors:
+                print("Error creating partition {0} for table {1}: {2}".format("/".join(values), table, errors[values]))
+                failed.append(values)
+            else:
+                known_partitions.add(values)
+    return failed
+
+def write_file_log(files):
+    """Record the new files in our DynamoDB log, 25 items per BatchWriteItem call.
+
+    Returns the files that could not be written, and the write capacity consumed."""
+    failed = []
+    consumed = 0.0
+    for start in range(0, len(files), max_items_per_write):
+        batch = files[start:start + max_items_per_write]
+        pending = [{
+            'PutRequest': {
+                'Item': {
+                    'File': {
+                        'S': f,
+                    },
+                    'IsProcessed': {
+                        'N': '0',
+                    },
+                    'Stream': {
+                        'S': table,
+                    },
+                }
+            }
+        } for f in batch]
+        attempt = 1
+        try:
+            while len(pending) > 0:
+                ddbresponse = ddbclient.batch_write_item(
+                    RequestItems={ddbtable: pending},
+                    ReturnConsumedCapacity='TOTAL'
+                )
+                for capacity in ddbresponse.get('ConsumedCapacity', []):
+                    consumed = consumed + capacity.get('CapacityUnits', 0.0)
+                pending = ddbresponse.get('UnprocessedItems', {}).get(ddbtable, [])
+                if len(pending) == 0:
+                    break
+                if attempt == max_write_attempts:
+                    failed.extend(request['PutRequest']['Item']['File']['S'] for request in pending)
+                    break
+                time.sleep(retry_base_seconds * (2 ** attempt))
+                attempt = attempt + 1
+        except Exception as e:
+            trc = traceback.format_exc()
+            print("Error recording new files {0} in DynamoDB: {1}".format(batch, trc))
+            failed.extend(batch)
+    return failed, consumed
+
 def handler(event, context):
+    """Log and partition every new object in the S3 event in one pass.
+
+    Prints one JSON summary with the outcome for each partition the event touched."""
 
     bad_records = []
     bad_inserts = []
+    partitions = set()
+    files = {}
+    skipped = 0
     for record in event['Records']:
         bucket = record['s3']['bucket']['name']
         key = record['s3']['object']['key'] 
@@ -44,89 +179,64 @@ def handler(event, context):
         m = re.search(prefix + '\/(\d{4})\/(\d{2})\/(\d{2})\/(\d{2})', key)
         if m == None:
             print("Did not find partition pattern, skipping: {0}".format(key))
+            skipped = skipped + 1
             continue
-        year = m.group(1)
-        month = m.group(2)
-        day = m.group(3)
-        hour = m.group(4)
-        partition = "{0}/{1}/{2}/{3}".format(year, month, day, hour)
+        values = m.group(1, 2, 3, 4)
+        partition = "/".join(values)
+        partitions.add(values)
 
-        # record this new file in our DynamoDB log
-        try:
-            if table in allowed_streams:
-                ddbresponse = ddbclient.put_item(
-                    Item={
-                        'File': {
-                            'S': "{0}/{1}".format(bucket, key),
-                        },
-                        'IsProcessed': {
-                            'N': '0',
-                        },
-                        'Stream': {
-                            'S': table,
-                        },
-                    },
-                    ReturnConsumedCapacity='TOTAL',
-                    TableName=ddbtable
-                )
-        except Exception as e:
-            trc = traceback.format_exc()
-            print("Error recording new file {0}/{1} in DynamoDB: {2}".format(bucket, key, trc))
-            bad_inserts.append(partition)
+        # remember this new file for our DynamoDB log
+        if table in allowed_streams:
+            files["{0}/{1}".format(bucket, key)] = partition
 
-        # See if partition already exists
-        exists = True
-        tbl = None
-        try:
-            tbl = client.get_table(
-                DatabaseName=databaseName,
-                Name=table
-            )
-            response = client.get_partition(
-                DatabaseName=databaseName,
-                TableName=table,
-                PartitionValues=[
-                    year,
-                    month,
-                    day,
-                    hour
-                ]
-            )
-            print("Partition {0} already exists for table {1}, skipping".format(partition, table))
-        except Exception as e:
-            exists = False
-            print("Partition {0} does not exist for table {1}, creating".format(partition, table))
-
-        if exists == False:
-            try:
-                sdescriptor = tbl['Table']['StorageDescriptor']
-                response = client.create_partition(
-                    DatabaseName=databaseName,
-                    TableName=table,
-                    PartitionInput={
-                        'Values': [
-                            year,
-                            month,
-                            day,
-                            hour
-                        ],
-                        'StorageDescriptor': {
-                            'Columns': sdescriptor['Columns'],
-                            'Location': "{0}/{1}/".format(sdescriptor['Location'], partition),
-                            'InputFormat': sdescriptor['InputFormat'],
-                            'OutputFormat': sdescriptor['OutputFormat'],
-                            'Compressed': True,
-                            'SerdeInfo': sdescriptor['SerdeInfo'],
-                            'Parameters': sdescriptor['Parameters'],
-                            'StoredAsSubDirectories': False
-                        },
-                        'Parameters': tbl['Table']['Parameters']
-                    }
-                )
+    if len(files) > 0:
+        failed, consumed = write_file_log(sorted(files))
+        for f in failed:
+            print("Error recording new file {0} in DynamoDB".format(f))
+            bad_inserts.append(files[f])
+        print("Recorded {0} new files in DynamoDB, consuming {1} write capacity units".format(len(files) - len(failed), consumed))
+
+    # Only look up the hours we haven't seen before, and create the missing ones together
+    unknown = sorted(partitions - known_partitions)
+    existing = set()
+    try:
+        if len(unknown) > 0:
+            existing = find_existing_partitions(unknown)
+            known_partitions.update(existing)
+            missing = [values for values in unknown if values not in existing]
+            print("Partitions {0} already exist for table {1}, creating {2}".format(
+                ["/".join(values) for values in existing], table, ["/".join(values) for values in missing]))
+            if len(missing) > 0:
+                bad_records.extend("/".join(values) for values in create_partitions(missing))
+    except Exception as e:
+        trc = traceback.format_exc()
+        print("Error creating partitions {0} for table {1}: {2}".format(["/".join(values) for values in unknown], table, trc))
+        bad_records.extend("/".join(values) for values in unknown if values not in known_partitions)
 
-            except Exception as e:
-                trc = traceback.format_exc()
-                print("Error creating partition {0} for table {1}: {2}".format(partition, table, trc))
-                bad_records.append(partition)
+    summary = {
+        'table': table,
+        'records': len(event['Records']),
+        'skipped': skipped,
+        'files_logged': len(files) - len(bad_inserts),
+        'insert_failures': len(bad_inserts),
+        'partition_failures': len(bad_records),
+        'partitions': {}
+    }
+    for values in sorted(partitions):
+        partition = "/".join(values)
+        if partition in bad_records:
+            status = 'failed'
+        elif values not in unknown:
+            status = 'cached'
+        elif values in existing:
+            status = 'exists'
+        else:
+            status = 'created'
+        summary['partitions'][partition] = {
+            'status': status,
+            'files': len([f for f in files if files[f] == partition]),
+            'insert_failures': bad_inserts.count(partition)
+        }
+    print(json.dumps(summary, sort_keys=True))
 
-        return 'Processed {0} records, with {1} partition failures and {2} insert failures.'.format(len(event['Records']), len(bad_records), len(bad_inserts))
+    return 'Processed {0} records, with {1} partition failures and {2} insert failures.'.format(len(event['Records']), len(bad_records), len(bad_inserts))
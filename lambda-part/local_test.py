@@ -0,0 +1,121 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Runs the partition handler locally against stubbed Glue and DynamoDB clients.
+#
+# Builds S3 notifications for files spread over a few hours, then keeps invoking
+# the handler with the records whose files haven't been logged yet, the way S3
+# redelivers them, counting the invocations and AWS calls it takes to handle
+# each event.  Needs boto3 installed, but makes no AWS calls.
+#
+# Usage: python local_test.py
+
+from __future__ import print_function
+
+import os
+import sys
+
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ['PartitionFor'] = 'enhclicks'
+os.environ['DatabaseName'] = 'ecommerce'
+os.environ['PartitionPrefix'] = 'enhclicks'
+os.environ['DdbTable'] = 'PartitionTracking'
+os.environ['DdbStreams'] = 'enhclicks'
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import index
+
+files_per_hour = 12
+
+
+class StubGlue(object):
+    def __init__(self, calls):
+        self.calls = calls
+        self.partitions = set()
+        self.looked_up = set()
+
+    def get_table(self, DatabaseName, Name):
+        self.calls['glue'] = self.calls['glue'] + 1
+        return {'Table': {
+            'StorageDescriptor': {
+                'Columns': [],
+                'Location': 's3://bucket/enhclicks',
+                'InputFormat': 'org.apache.hadoop.mapred.TextInputFormat',
+                'OutputFormat': 'org.apache.hadoop.hive.ql.io.HiveIgnoreKeyTextOutputFormat',
+                'SerdeInfo': {},
+                'Parameters': {}
+            },
+            'Parameters': {}
+        }}
+
+    def batch_get_partition(self, DatabaseName, TableName, PartitionsToGet):
+        self.calls['glue'] = self.calls['glue'] + 1
+        self.looked_up.update(tuple(p['Values']) for p in PartitionsToGet)
+        return {'Partitions': [p for p in PartitionsToGet if tuple(p['Values']) in self.partitions]}
+
+    def batch_create_partition(self, DatabaseName, TableName, PartitionInputList):
+        self.calls['glue'] = self.calls['glue'] + 1
+        for p in PartitionInputList:
+            self.partitions.add(tuple(p['Values']))
+        return {'Errors': []}
+
+
+class StubDynamoDB(object):
+    def __init__(self, calls):
+        self.calls = calls
+        self.files = set()
+
+    def batch_write_item(self, RequestItems, ReturnConsumedCapacity):
+        self.calls['dynamodb'] = self.calls['dynamodb'] + 1
+        for requests in RequestItems.values():
+            for request in requests:
+                self.files.add(request['PutRequest']['Item']['File']['S'])
+        return {'UnprocessedItems': {}, 'ConsumedCapacity': [
+            {'TableName': table, 'CapacityUnits': float(len(requests))} for table, requests in RequestItems.items()]}
+
+
+def s3_event(day, hours):
+    return {'Records': [{'s3': {
+        'bucket': {'name': 'bucket'},
+        'object': {'key': 'enhclicks/2018/06/{0:02d}/{1:02d}/part-{2}'.format(day, hour, i)}
+    }} for hour in hours for i in range(files_per_hour)]}
+
+
+if __name__ == '__main__':
+    calls = {'glue': 0, 'dynamodb': 0}
+    index.client = StubGlue(calls)
+    index.ddbclient = StubDynamoDB(calls)
+
+    # The second event shares hour 2 with the first, which the warm container already
+    # knows about, so only its two new hours cost a lookup and a create.  The first
+    # event also pays for reading the table.  Either way the 36 files take two
+    # BatchWriteItem calls of at most 25 items.
+    expected = [(3, 2, [0, 1, 2]), (2, 2, [3, 4])]
+    for event, (glue_calls, dynamodb_calls, looked_up) in zip([s3_event(1, [0, 1, 2]), s3_event(1, [2, 3, 4])], expected):
+        calls['glue'] = 0
+        calls['dynamodb'] = 0
+        index.client.looked_up.clear()
+        pending = event['Records']
+        invocations = 0
+        while len(pending) > 0:
+            index.handler({'Records': pending}, None)
+            invocations = invocations + 1
+            pending = [r for r in pending if "{0}/{1}".format(r['s3']['bucket']['name'], r['s3']['object']['key']) not in index.ddbclient.files]
+        print("{0} records: {1} invocations, {2} Glue calls, {3} DynamoDB calls".format(
+            len(event['Records']), invocations, calls['glue'], calls['dynamodb']))
+        assert invocations == 1
+        assert calls['glue'] == glue_calls
+        assert calls['dynamodb'] == dynamodb_calls
+        assert index.client.looked_up == set(('2018', '06', '01', '{0:02d}'.format(hour)) for hour in looked_up)
@@ -0,0 +1,89 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Measures how compaction in retrain.compact_dataset changes the time to read the
+# merged click data.
+#
+# Appends many small gzip batches to a local parquet dataset, the way nightly
+# retrains used to, times a full read, compacts it and times the read again.
+# Needs pyspark and sagemaker_pyspark installed.
+#
+# Usage: spark-submit bench_compaction.py [batches] [rows_per_batch] [codec]
+
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from pyspark.sql import SparkSession
+import pyspark.sql.functions as F
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from retrain import compact_dataset, list_data_files
+
+
+def append_batches(spark, path, batches, rows_per_batch):
+    for i in range(batches):
+        spark.range(rows_per_batch) \
+            .select(
+                F.concat(F.lit("user"), (F.col("id") % 1000).cast("string")).alias("userid"),
+                F.concat(F.lit("offer"), (F.col("id") % 20).cast("string")).alias("offerid"),
+                F.lit("de").alias("countrycode"),
+                (F.col("id") % 7).cast("string").alias("category"),
+                F.concat(F.lit("product"), (F.col("id") % 20).cast("string")).alias("product"),
+                (F.col("id") % 2).cast("string").alias("label"),
+                F.lit("batch{0}".format(i)).alias("ingest_batch")) \
+            .repartition(4) \
+            .write.option("compression", "gzip").parquet(path, mode="append")
+
+
+def time_read(spark, path):
+    start = time.time()
+    rows = spark.read.option("mergeSchema", "true").parquet(path).groupBy("offerid").count().collect()
+    return time.time() - start, sum(row['count'] for row in rows)
+
+
+if __name__ == "__main__":
+    batches = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    rows_per_batch = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    codec = sys.argv[3] if len(sys.argv) > 3 else "snappy"
+
+    spark = SparkSession.builder.appName("BenchCompaction").getOrCreate()
+    workdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(workdir, "merged.parquet")
+        log_path = os.path.join(workdir, "merged-compaction-log.parquet")
+        append_batches(spark, path, batches, rows_per_batch)
+
+        files = sum(len(f) for f in list_data_files(spark, path).values())
+        seconds, rows = time_read(spark, path)
+        print("Before: {0} rows in {1} gzip files, read in {2:.2f}s".format(rows, files, seconds))
+
+        start = time.time()
+        compact_dataset(spark, path, log_path, 128 * 1024 * 1024, codec)
+        print("Compaction took {0:.2f}s".format(time.time() - start))
+
+        files = sum(len(f) for f in list_data_files(spark, path).values())
+        seconds, rows = time_read(spark, path)
+        print("After: {0} rows in {1} {2} files, read in {3:.2f}s".format(rows, files, codec, seconds))
+
+        # A second pass finds nothing to do
+        compact_dataset(spark, path, log_path, 128 * 1024 * 1024, codec)
+    finally:
+        shutil.rmtree(workdir)
+        spark.stop()
@@ -0,0 +1,88 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Compares reading click files one at a time and chaining unions, as retrain.py
+# used to, against the single multi-path read in retrain.read_click_files.
+#
+# Writes thousands of small click CSV files to a local temporary directory, then
+# times building the query plan and counting the rows each way.  Needs pyspark
+# and sagemaker_pyspark installed.
+#
+# Usage: spark-submit bench_read_clicks.py [num_files] [rows_per_file]
+
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from pyspark.sql import SparkSession
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from retrain import clicks_schema, read_click_files
+
+
+def write_click_files(directory, num_files, rows_per_file):
+    paths = []
+    for i in range(num_files):
+        path = os.path.join(directory, "clicks-{0:05d}.csv".format(i))
+        with open(path, 'w') as f:
+            for j in range(rows_per_file):
+                f.write("user{0},offer{1},de,{2},product{3},2018-06-14 17:28:47.0,{4}\n".format(
+                    (i * rows_per_file + j) % 1000, j % 20, j % 7, j % 20, j % 2))
+        paths.append(path)
+    return paths
+
+
+def read_click_files_union(spark, paths):
+    clicksDf = None
+    for path in paths:
+        dfLocal = spark.read.csv(
+            path, header=False, mode="DROPMALFORMED", schema=clicks_schema
+        )
+        if clicksDf is None:
+            clicksDf = dfLocal
+        else:
+            clicksDf = clicksDf.union(dfLocal)
+    return clicksDf
+
+
+def bench(name, spark, read, paths):
+    start = time.time()
+    df = read(spark, paths)
+    # Force analysis, optimization and physical planning without running anything
+    df._jdf.queryExecution().executedPlan()
+    planned = time.time()
+    rows = df.count()
+    done = time.time()
+    print("{0}: {1} rows from {2} files, planning {3:.2f}s, reading {4:.2f}s".format(
+        name, rows, len(paths), planned - start, done - planned))
+
+
+if __name__ == "__main__":
+    num_files = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    rows_per_file = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    spark = SparkSession.builder.appName("BenchReadClicks").getOrCreate()
+    workdir = tempfile.mkdtemp()
+    try:
+        paths = write_click_files(workdir, num_files, rows_per_file)
+        bench("Per-file union", spark, read_click_files_union, paths)
+        bench("Multi-path read", spark, read_click_files, paths)
+    finally:
+        shutil.rmtree(workdir)
+        spark.stop()
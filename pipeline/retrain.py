@@ -15,22 +15,22 @@
 
 from __future__ import print_function
 import sys
+import argparse
 import math
 import json
 import time
-from pyspark import SparkContext, SparkConf
-
-from pyspark.mllib.evaluation import MulticlassMetrics
-from pyspark.mllib.evaluation import BinaryClassificationMetrics
+import uuid
+from contextlib import contextmanager
+from pyspark import SparkContext, SparkConf, StorageLevel
 
 import pyspark.sql.functions as F
 from pyspark.sql.functions import col, round, explode, desc
 
-import pyspark.sql.types as T
-from pyspark.sql.types import StructType, StringType, IntegerType, StructField, DoubleType, ArrayType
-from pyspark.sql import SparkSession
+from pyspark.sql.types import StructType, StringType, IntegerType, LongType, StructField, DoubleType, ArrayType
+from pyspark.sql import SparkSession, Window
+from pyspark.sql.utils import AnalysisException
 
-from pyspark.ml.feature import OneHotEncoder, StringIndexer, VectorAssembler
+from pyspark.ml.feature import OneHotEncoder, VectorAssembler
 
 from sagemaker_pyspark import IAMRole, classpath_jars, SageMakerEstimator
 from sagemaker_pyspark.transformation.serializers.serializers import ProtobufRequestRowSerializer
@@ -43,84 +43,342 @@ def read_unprocessed_partitions(spark, s3_path):
     dfPartitions = dfItems.select(col("Items.File.S").alias("file"),col("Items.IsProcessed.N").alias("processed"),col("Items.Stream.S").alias("stream"))
     return dfPartitions
 
-def read_click_partitions(spark, dfInput):
-
-    schema = StructType([
-        StructField("userid", StringType()),
-        StructField("offerid", StringType()),
-        StructField("countrycode", StringType()),
-        StructField("category", StringType()),
-        StructField("product", StringType()),
-        StructField("timestamp", StringType()),
-        StructField("label", StringType())
-    ])
-
-    clicksDf = None
-    for s3file in dfInput.rdd.collect():
-        path = "s3://{0}".format(s3file.file)
-        if clicksDf == None:
-            clicksDf = spark.read.csv(
-                path, header=False, mode="DROPMALFORMED", schema=schema
-            )
+clicks_schema = StructType([
+    StructField("userid", StringType()),
+    StructField("offerid", StringType()),
+    StructField("countrycode", StringType()),
+    StructField("category", StringType()),
+    StructField("product", StringType()),
+    StructField("timestamp", StringType()),
+    StructField("label", StringType())
+])
+
+# Categorical features, in the order they're assembled into the feature vector
+feature_columns = ["userid", "product", "category", "offerid", "countrycode"]
+
+def read_click_files(spark, paths):
+    # Read every file in one call, so the plan has a single scan however many files there are
+    if len(paths) == 0:
+        return spark.createDataFrame([], clicks_schema)
+    return spark.read.csv(
+        paths, header=False, mode="DROPMALFORMED", schema=clicks_schema
+    )
+
+def read_click_partitions(spark, files):
+    paths = ["s3://{0}".format(f) for f in files]
+    print("Reading {0} click files".format(len(paths)))
+    return read_click_files(spark, paths)
+
+manifestSchema = StructType() \
+    .add("file", StringType()) \
+    .add("ingest_batch", StringType()) \
+    .add("committed_at", DoubleType())
+
+def read_ingest_manifest(spark, s3_manifest_path):
+    try:
+        return spark.read.schema(manifestSchema).parquet(s3_manifest_path)
+    except AnalysisException:
+        return None
+
+def select_new_files(dfInput, dfManifest):
+    """Return the files in dfInput that no committed ingest batch has read yet."""
+    dfFiles = dfInput.select("file").distinct()
+    if dfManifest is not None:
+        dfFiles = dfFiles.join(dfManifest.select("file"), "file", "left_anti")
+    return sorted(row.file for row in dfFiles.collect())
+
+def commit_ingest(spark, files, ingest_batch, s3_manifest_path):
+    """Record that the rows tagged ingest_batch, read from files, are in the merged data.
+
+    Until this is written, readers of the merged data ignore the batch, so a run that
+    fails part way leaves no duplicates behind and its files are read again next time."""
+    committed_at = time.time()
+    dfCommit = spark.createDataFrame([(f, ingest_batch, committed_at) for f in files], manifestSchema)
+    dfCommit.coalesce(1).write.parquet(s3_manifest_path, mode="append")
+
+def read_committed_clicks(spark, s3_merged_path, s3_manifest_path):
+    """Read the merged click data, keeping only rows from committed ingest batches.
+
+    Rows written before batches were tagged have no ingest_batch and are all kept.
+    Returns None if there is no data at s3_merged_path."""
+    try:
+        dfMerged = spark.read.option("mergeSchema", "true").parquet(s3_merged_path)
+    except AnalysisException:
+        return None
+    if "ingest_batch" not in dfMerged.columns:
+        return dfMerged
+    dfManifest = read_ingest_manifest(spark, s3_manifest_path)
+    batches = []
+    if dfManifest is not None:
+        batches = [row.ingest_batch for row in dfManifest.select("ingest_batch").distinct().collect()]
+    return dfMerged.filter(col("ingest_batch").isNull() | col("ingest_batch").isin(batches))
+
+# The YYYY/MM/DD/HH directories Firehose delivers clicks to, and lambda-part registers in Glue
+hour_pattern = r"/(\d{4})/(\d{2})/(\d{2})/(\d{2})/[^/]*$"
+hour_columns = ["year", "month", "day", "hour"]
+
+def with_click_hour(dfClicks):
+    """Add year, month, day and hour columns for the hour each click was delivered in.
+
+    They come from the directory of the file the click was read from, or from the
+    epoch timestamp for files outside the usual layout.  Must be applied straight
+    to the DataFrame read from the click files."""
+    path = F.input_file_name()
+    clicked = F.from_unixtime(col("timestamp").cast(DoubleType()).cast(LongType()))
+    for group, name, fmt in zip(range(1, 5), hour_columns, ["yyyy", "MM", "dd", "HH"]):
+        part = F.regexp_extract(path, hour_pattern, group)
+        dfClicks = dfClicks.withColumn(name, F.when(part != "", part).otherwise(F.date_format(clicked, fmt)))
+    return dfClicks
+
+def read_click_history(spark, s3_history_path, s3_legacy_path, s3_manifest_path, window_days):
+    """Read the committed clicks, only from the last window_days days if it isn't None.
+
+    The history is partitioned by hour, so the window prunes whole directories.  The
+    unpartitioned clicks merged before that have no dates, and are only read for
+    the full history."""
+    frames = []
+    dfHistory = read_committed_clicks(spark, s3_history_path, s3_manifest_path)
+    if dfHistory is not None:
+        if window_days is not None:
+            cutoff = int(time.strftime("%Y%m%d", time.gmtime(time.time() - window_days * 86400)))
+            print("Reading clicks since {0}".format(cutoff))
+            dfHistory = dfHistory.filter(col("year") * 10000 + col("month") * 100 + col("day") >= cutoff)
+        frames.append(dfHistory)
+    if window_days is None:
+        dfLegacy = read_committed_clicks(spark, s3_legacy_path, s3_manifest_path)
+        if dfLegacy is not None:
+            frames.append(dfLegacy)
+    if len(frames) == 0:
+        raise ValueError("There is no click data in {0} or {1}".format(s3_history_path, s3_legacy_path))
+
+    columns = feature_columns + ["label"]
+    dfFull = frames[0].select(*columns)
+    for frame in frames[1:]:
+        dfFull = dfFull.union(frame.select(*columns))
+    return dfFull
+
+# Vocabularies up to this size are looked up with a literal map instead of a join
+max_map_values = 1000
+
+# Vocabularies up to this size are broadcast when they are joined
+max_broadcast_values = 100000
+
+def read_vocabularies(spark, s3_vocab_path):
+    try:
+        return spark.read.parquet(s3_vocab_path)
+    except AnalysisException:
+        return None
+
+def feature_values(df, features):
+    # One (feature, value) row per feature of each row of df
+    pairs = F.explode(F.array(*[F.struct(F.lit(f).alias("feature"), col(f).alias("value")) for f in features]))
+    return df.select(pairs.alias("pair")).select("pair.feature", "pair.value")
+
+def update_vocabularies(spark, dfNew, read_full, s3_vocab_path):
+    """Extend the per-feature vocabularies with the values first seen in dfNew.
+
+    The vocabularies are an append-only (value, idx) table partitioned by feature
+    under s3_vocab_path, so a value keeps its index from one run to the next, and
+    running this twice on the same data adds nothing the second time.  The new values
+    of every feature are found in a single aggregation.  Features without a vocabulary
+    yet are fitted on the DataFrame read_full() returns, which is only called for them.
+    Returns the updated vocabularies by feature."""
+    dfVocab = read_vocabularies(spark, s3_vocab_path)
+    next_idx = {}
+    if dfVocab is not None:
+        for row in dfVocab.groupBy("feature").agg(F.max("idx").alias("idx")).collect():
+            next_idx[row.feature] = row.idx + 1
+
+    known = [f for f in feature_columns if f in next_idx]
+    unknown = [f for f in feature_columns if f not in next_idx]
+    dfValues = None
+    if len(known) > 0:
+        dfValues = feature_values(dfNew, known)
+    if len(unknown) > 0:
+        dfUnknown = feature_values(read_full(), unknown)
+        dfValues = dfUnknown if dfValues is None else dfValues.union(dfUnknown)
+    dfValues = dfValues.distinct()
+    if dfVocab is not None:
+        dfValues = dfValues.join(dfVocab, ["feature", "value"], "left_anti")
+
+    # New values are numbered after the existing ones, in sorted order
+    offset = F.lit(0)
+    if len(next_idx) > 0:
+        offset = F.coalesce(F.create_map(*[F.lit(x) for item in next_idx.items() for x in item])[col("feature")], offset)
+    dfAdded = dfValues.withColumn("idx", (F.row_number().over(Window.partitionBy("feature").orderBy("value")) - 1 + offset).cast(IntegerType()))
+    dfAdded.select("value", "idx", "feature").write.partitionBy("feature").parquet(s3_vocab_path, mode="append")
+
+    dfVocab = spark.read.parquet(s3_vocab_path)
+    return dict((f, dfVocab.filter(col("feature") == f).select("value", "idx")) for f in feature_columns)
+
+# Name of the column each feature's values outside its vocabulary are encoded in
+unknown_value = "__unknown"
+
+def encode_features(dfFull, vocabs):
+    """Turn the click columns into a double label and a sparse one-hot features vector.
+
+    Each feature is indexed with its vocabulary from update_vocabularies, through a
+    literal map for small vocabularies and a join for large ones, all in one select.
+    Values missing from the vocabulary get a reserved index one past the last value,
+    so no row is lost.  The index columns are labelled with the vocabulary so the
+    encoders, and in turn the features vector, name each column "<feature>_<value>"."""
+
+    dfIndexed = dfFull.fillna('0')
+    exprs = [col("label").cast(DoubleType()).alias("label")]
+    for feature in feature_columns:
+        indexes = dict((row.idx, row.value) for row in vocabs[feature].collect())
+        unknown_idx = max(indexes) + 1 if len(indexes) > 0 else 0
+        values = [indexes.get(i, "__unused_{0}".format(i)) for i in range(unknown_idx)] + [unknown_value]
+        print("Vocabulary for {0} has {1} values".format(feature, len(indexes)))
+
+        meta = {"ml_attr": {"type": "nominal", "name": feature, "vals": values}}
+        index_column = "{0}_idx".format(feature)
+        if len(indexes) <= max_map_values:
+            lookup = F.create_map(*[F.lit(x) for idx, value in indexes.items() for x in (value, float(idx))])
+            index = lookup[col(feature)]
         else:
-            dfLocal = spark.read.csv(
-                path, header=False, mode="DROPMALFORMED", schema=schema
-            )
-            clicksDf = clicksDf.union(dfLocal)
-
-    return clicksDf
-
-def one_hot_encode(dfFull):
-
-    dfNoNullNumbers = dfFull.fillna('0')
-
-    # start with user id
-    stringIndexer_user = StringIndexer(inputCol="userid", outputCol="UserIdx", handleInvalid='keep')
-    model_user = stringIndexer_user.fit(dfNoNullNumbers)
-    indexed_user = model_user.transform(dfNoNullNumbers)
-
-    encoder_user = OneHotEncoder(inputCol="UserIdx", outputCol="UserVec")
-    encoded_user = encoder_user.transform(indexed_user)
-    
-    # now do item
-    stringIndexer_item = StringIndexer(inputCol="product", outputCol="ItemIdx", handleInvalid='keep')
-    model_item = stringIndexer_item.fit(encoded_user)
-    indexed_item = model_item.transform(encoded_user)
-
-    encoder_item = OneHotEncoder(inputCol="ItemIdx", outputCol="ItemVec")
-    encoded_item = encoder_item.transform(indexed_item)
-
-    # now do category
-    stringIndexer_cat = StringIndexer(inputCol="category", outputCol="CategoryCleanedIdx", handleInvalid='keep')
-    model_cat = stringIndexer_cat.fit(encoded_item)
-    indexed_cat = model_cat.transform(encoded_item)
-
-    encoder_cat = OneHotEncoder(inputCol="CategoryCleanedIdx", outputCol="CategoryCleanedVec")
-    encoded_cat = encoder_cat.transform(indexed_cat)
-
-    # now do offerid
-    stringIndexer_offer = StringIndexer(inputCol="offerid", outputCol="OfferIdx", handleInvalid='keep')
-    model_offer = stringIndexer_offer.fit(encoded_cat)
-    indexed_offer = model_offer.transform(encoded_cat)
-
-    encoder_offer = OneHotEncoder(inputCol="OfferIdx", outputCol="OfferVec")
-    encoded_offer = encoder_offer.transform(indexed_offer)
-
-    # now do countrycode
-    stringIndexer_cc = StringIndexer(inputCol="countrycode", outputCol="CcIdx", handleInvalid='keep')
-    model_cc = stringIndexer_cc.fit(encoded_offer)
-    indexed_cc = model_cc.transform(encoded_offer)
-
-    encoder_cc = OneHotEncoder(inputCol="CcIdx", outputCol="CcVec")
-    encoded_cc = encoder_cc.transform(indexed_cc)
+            dfIndex = vocabs[feature].select(col("value").alias(feature), col("idx").cast(DoubleType()).alias(index_column))
+            if len(indexes) <= max_broadcast_values:
+                dfIndex = F.broadcast(dfIndex)
+            dfIndexed = dfIndexed.join(dfIndex, feature, "left_outer")
+            index = col(index_column)
+        exprs.append(F.coalesce(index, F.lit(float(unknown_idx))).alias(index_column, metadata=meta))
+    dfIndexed = dfIndexed.select(*exprs)
+
+    # The encoders and assembler only add columns, so they run in the same stage
+    for feature in feature_columns:
+        encoder = OneHotEncoder(inputCol="{0}_idx".format(feature), outputCol=feature, dropLast=False)
+        dfIndexed = encoder.transform(dfIndexed)
+    assembler = VectorAssembler(
+        inputCols=feature_columns,
+        outputCol='features')
+    dfReadyForModel = assembler.transform(dfIndexed).select("label", "features")
 
-    dfEncoded = encoded_cc.drop('userid').drop('UserIdx') \
-        .drop('product').drop('ItemIdx') \
-        .drop('offerid').drop('OfferIdx') \
-        .drop('countrycode').drop('CcIdx') \
-        .drop('category').drop('CategoryCleanedIdx') 
+    return dfReadyForModel
 
-    return dfEncoded
+compactionLogSchema = StructType() \
+    .add("partition", StringType()) \
+    .add("files_before", IntegerType()) \
+    .add("files_after", IntegerType()) \
+    .add("bytes", LongType()) \
+    .add("codec", StringType()) \
+    .add("compacted_at", DoubleType())
+
+def list_data_files(spark, s3_dataset_path):
+    """Group the data files under s3_dataset_path by directory.
+
+    Returns {directory: [(path, size)]}, leaving out files and directories whose names
+    start with _ or ., which Spark doesn't read either."""
+    jvm = spark._jvm
+    root = jvm.org.apache.hadoop.fs.Path(s3_dataset_path)
+    fs = root.getFileSystem(spark._jsc.hadoopConfiguration())
+    root_path = fs.makeQualified(root).toString().rstrip("/")
+    dirs = {}
+    if not fs.exists(root):
+        return dirs
+    files = fs.listFiles(root, True)
+    while files.hasNext():
+        status = files.next()
+        path = status.getPath().toString()
+        relative = path[len(root_path):].strip("/")
+        if any(part.startswith("_") or part.startswith(".") for part in relative.split("/")):
+            continue
+        dirs.setdefault(status.getPath().getParent().toString(), []).append((path, status.getLen()))
+    return dirs
+
+# Written into a compaction's staging directory before its files are swapped in,
+# listing the files being replaced and the ones replacing them
+swap_marker = "_SWAP"
+
+def write_swap_marker(spark, fs, staging, directory, old_files, new_files):
+    marker = json.dumps({"directory": directory, "old": old_files, "new": new_files})
+    out = fs.create(spark._jvm.org.apache.hadoop.fs.Path(staging, swap_marker), True)
+    out.write(bytearray(marker.encode("utf-8")))
+    out.close()
+
+def finish_swap(spark, fs, staging):
+    """Complete or undo the swap recorded in staging by an interrupted compaction.
+
+    New files are only deleted from the dataset before any old file is, so if they
+    all made it into the directory the old files can go, and otherwise the new
+    ones are removed and the old ones, all still there, are kept."""
+    Path = spark._jvm.org.apache.hadoop.fs.Path
+    marker = Path(staging, swap_marker)
+    if fs.exists(marker):
+        swap = json.loads("".join(spark.sparkContext.textFile(marker.toString()).collect()))
+        moved = [Path(swap["directory"], Path(path).getName()) for path in swap["new"]]
+        if all(fs.exists(path) for path in moved):
+            print("Rolling forward the interrupted compaction of {0}".format(swap["directory"]))
+            for path in swap["old"]:
+                fs.delete(Path(path), False)
+        else:
+            print("Rolling back the interrupted compaction of {0}".format(swap["directory"]))
+            for path in moved:
+                fs.delete(path, False)
+    fs.delete(Path(staging), True)
+
+def compact_dataset(spark, s3_dataset_path, s3_log_path, target_bytes, codec):
+    """Rewrite the fragmented directories of a parquet dataset into files of about target_bytes.
+
+    A directory is fragmented when it holds more files than its size calls for, and
+    hasn't changed since the compaction log last recorded it.  Each one is rewritten
+    with codec beside the dataset, the new files moved in and the old ones deleted,
+    so no other job should read or write the dataset meanwhile.  The swap is recorded
+    before anything moves, and swaps left unfinished by an earlier run are completed
+    or undone first."""
+    Path = spark._jvm.org.apache.hadoop.fs.Path
+    fs = Path(s3_dataset_path).getFileSystem(spark._jsc.hadoopConfiguration())
+    staging_root = Path("{0}_compacting".format(s3_dataset_path.rstrip("/")))
+
+    if fs.exists(staging_root):
+        for status in fs.listStatus(staging_root):
+            finish_swap(spark, fs, status.getPath())
+
+    compacted = {}
+    try:
+        for row in spark.read.schema(compactionLogSchema).parquet(s3_log_path).collect():
+            if row.partition not in compacted or compacted[row.partition].compacted_at < row.compacted_at:
+                compacted[row.partition] = row
+    except AnalysisException:
+        pass
+
+    log = []
+    for directory, files in sorted(list_data_files(spark, s3_dataset_path).items()):
+        total_bytes = sum(size for path, size in files)
+        num_files = max(1, int(math.ceil(total_bytes / float(target_bytes))))
+        last = compacted.get(directory)
+        if last is not None and last.files_after == len(files) and last.bytes == total_bytes:
+            print("Skipping {0}: unchanged since it was compacted".format(directory))
+            continue
+        if len(files) <= num_files:
+            continue
+
+        print("Compacting {0}: {1} files, {2} bytes into {3} files".format(directory, len(files), total_bytes, num_files))
+        staging = Path(staging_root, uuid.uuid4().hex)
+        # Reading from the directory itself keeps any partition columns out of the files
+        spark.read.option("mergeSchema", "true").option("basePath", directory) \
+            .parquet(*[path for path, size in files]) \
+            .repartition(num_files) \
+            .write.option("compression", codec).parquet(staging.toString())
+
+        written = [f for staged in list_data_files(spark, staging.toString()).values() for f in staged]
+        write_swap_marker(spark, fs, staging, directory,
+                          [path for path, size in files], [path for path, size in written])
+        for path, size in written:
+            source = Path(path)
+            if not fs.rename(source, Path(directory, source.getName())):
+                finish_swap(spark, fs, staging)
+                raise IOError("Could not move {0} into {1}, compaction rolled back".format(path, directory))
+        for path, size in files:
+            fs.delete(Path(path), False)
+        fs.delete(staging, True)
+
+        log.append((directory, len(files), len(written), sum(size for path, size in written), codec, time.time()))
+
+    if len(log) > 0:
+        spark.createDataFrame(log, compactionLogSchema).coalesce(1).write.parquet(s3_log_path, mode="append")
+    print("Compacted {0} directories".format(len(log)))
+    return log
 
 def train_tffm(roleArn, image_uri, header_file_bucket, header_file_prefix, train_instance_type, endpoint_instance_type, train_df):
 
@@ -142,6 +400,74 @@ def train_tffm(roleArn, image_uri, header_file_bucket, header_file_prefix, train
     model = estimator.fit(train_df)
     return model
 
+# Scores are rounded to this many decimals to build the ROC and PR curves
+score_bin_decimals = 3
+
+def ratio(numerator, denominator):
+    return float(numerator) / denominator if denominator > 0 else 0.0
+
+def f_measure(precision, recall, beta=1.0):
+    beta2 = beta * beta
+    return ratio((1 + beta2) * precision * recall, beta2 * precision + recall)
+
+def area_under_curve(points):
+    area = 0.0
+    for (x0, y0), (x1, y1) in zip(points, points[1:]):
+        area = area + (x1 - x0) * (y0 + y1) / 2.0
+    return area
+
+def binary_metrics(bins, threshold):
+    """Compute the validation metrics from (bin, predicted, count, positives) score bins.
+
+    ROC and PR areas come from the bins of the raw scores.  The rest are for the
+    scores thresholded into predicted, with the same definitions as Spark's
+    MulticlassMetrics: precision, recall and F1 over all rows, and the per-class
+    metrics weighted by how often each label occurs."""
+    tp = sum(b.positives for b in bins if b.predicted)
+    fp = sum(b.count - b.positives for b in bins if b.predicted)
+    fn = sum(b.positives for b in bins if not b.predicted)
+    tn = sum(b.count - b.positives for b in bins if not b.predicted)
+    total = tp + fp + fn + tn
+    print("Confusion matrix at threshold {0}: TP {1}, FP {2}, FN {3}, TN {4}".format(threshold, tp, fp, fn, tn))
+
+    # Sweep the threshold down through the score bins
+    scores = {}
+    for b in bins:
+        counts = scores.setdefault(b.bin, [0, 0])
+        counts[0] = counts[0] + b.positives
+        counts[1] = counts[1] + b.count - b.positives
+    cum_tp = 0
+    cum_fp = 0
+    roc = [(0.0, 0.0)]
+    pr = []
+    for score in sorted(scores, reverse=True):
+        cum_tp = cum_tp + scores[score][0]
+        cum_fp = cum_fp + scores[score][1]
+        roc.append((ratio(cum_fp, fp + tn), ratio(cum_tp, tp + fn)))
+        pr.append((ratio(cum_tp, tp + fn), ratio(cum_tp, cum_tp + cum_fp)))
+    if len(pr) > 0:
+        pr.insert(0, (0.0, pr[0][1]))
+
+    # Per-class precision, recall, false positive rate and weight, for labels 1 and 0
+    classes = [
+        (ratio(tp, tp + fp), ratio(tp, tp + fn), ratio(fp, fp + tn), ratio(tp + fn, total)),
+        (ratio(tn, tn + fn), ratio(tn, tn + fp), ratio(fn, fn + tp), ratio(tn + fp, total))
+    ]
+    accuracy = ratio(tp + tn, total)
+
+    return [
+        ("Area_under_PR", area_under_curve(pr)),
+        ("Area_under_ROC", area_under_curve(roc)),
+        ("Precision", accuracy),
+        ("Recall", accuracy),
+        ("F1", accuracy),
+        ("Weighted_recall", sum(w * r for p, r, fpr, w in classes)),
+        ("Weighted_precision", sum(w * p for p, r, fpr, w in classes)),
+        ("Weighted_F1", sum(w * f_measure(p, r) for p, r, fpr, w in classes)),
+        ("Weighted_F05", sum(w * f_measure(p, r, beta=0.5) for p, r, fpr, w in classes)),
+        ("Weighted_FP_rate", sum(w * fpr for p, r, fpr, w in classes))
+    ]
+
 def validate_tffm(spark, sc, model, test_df, s3_metrics_path, s3_endpoint_path):
     # get predictions
     validation_df = model.transform(test_df)
@@ -149,35 +475,18 @@ def validate_tffm(spark, sc, model, test_df, s3_metrics_path, s3_endpoint_path):
     metricsSchema = StructType() \
         .add("metric", StringType()) \
         .add("value", DoubleType())
-    metrics_names = []
-
-    # apply threshold
-    def thresholdScore(x):
-        retval = 0.0
-        if x > 0.5:
-            retval = 1.0
-        return retval
-    
-    thresholdScoreUdf = F.UserDefinedFunction(thresholdScore, T.FloatType())
-    
-    validation_df_round = validation_df.withColumn('rscore', thresholdScoreUdf(validation_df.score)) 
-    predTffm = validation_df_round.select(['label','rscore'])
-
-    predictionAndLabelsTffm = predTffm.rdd.map(lambda lp: (lp.rscore, lp.label))
-    metricsTffm = BinaryClassificationMetrics(predictionAndLabelsTffm)
-
-    metrics_names.append(("Area_under_PR",metricsTffm.areaUnderPR))
-    metrics_names.append(("Area_under_ROC",metricsTffm.areaUnderROC))
 
-    mmetricsTffm = MulticlassMetrics(predictionAndLabelsTffm)
-    metrics_names.append(("Precision",mmetricsTffm.precision()))
-    metrics_names.append(("Recall",mmetricsTffm.recall()))
-    metrics_names.append(("F1",mmetricsTffm.fMeasure()))
-    metrics_names.append(("Weighted_recall",mmetricsTffm.weightedRecall))
-    metrics_names.append(("Weighted_precision",mmetricsTffm.weightedPrecision))
-    metrics_names.append(("Weighted_F1",mmetricsTffm.weightedFMeasure()))
-    metrics_names.append(("Weighted_F05",mmetricsTffm.weightedFMeasure(beta=0.5)))
-    metrics_names.append(("Weighted_FP_rate",mmetricsTffm.weightedFalsePositiveRate))
+    # count rows and positive labels by score bin and thresholded prediction, in one aggregation
+    threshold = 0.5
+    bins = validation_df \
+        .groupBy(
+            round(col("score"), score_bin_decimals).alias("bin"),
+            (col("score") > threshold).alias("predicted")) \
+        .agg(
+            F.count(F.lit(1)).alias("count"),
+            F.sum(F.when(col("label") == 1.0, 1).otherwise(0)).alias("positives")) \
+        .collect()
+    metrics_names = binary_metrics(bins, threshold)
 
     mRdd = sc.parallelize(metrics_names).coalesce(1)
     dfMetrics = spark.createDataFrame(mRdd, metricsSchema)
@@ -192,27 +501,6 @@ def validate_tffm(spark, sc, model, test_df, s3_metrics_path, s3_endpoint_path):
     dfEndpoint = spark.createDataFrame(eRdd, endpointSchema)
     dfEndpoint.write.csv("{0}/endpoint.txt".format(s3_endpoint_path), mode="overwrite")
 
-def prepare_features(dfEncoded):
-
-    # drop unused columns
-    dfLabeled = dfEncoded.withColumn("dlabel", dfEncoded["label"].cast(DoubleType())).drop("label")
-    dfLabeled = dfLabeled.withColumnRenamed("dlabel", "label")
-    dfLabeled = dfLabeled.withColumnRenamed("UserVec", "userid") \
-        .withColumnRenamed("ItemVec", "product") \
-        .withColumnRenamed("OfferVec", "offerid") \
-        .withColumnRenamed("CcVec", "countrycode") \
-        .withColumnRenamed("CategoryCleanedVec", "category") 
-
-    # assemble into feature vector
-    ignore = ['label']
-    assembler = VectorAssembler(
-        inputCols=[x for x in dfLabeled.columns if x not in ignore],
-        outputCol='features')
-    dfFeatures = assembler.transform(dfLabeled)
-    dfReadyForModel = dfFeatures.drop('userid').drop('product').drop('category').drop('countrycode').drop('offerid')
-
-    return dfReadyForModel
-
 def save_lookups(spark, dfReadyForModel, s3_header_path):
     lookupSchema = StructType() \
         .add("name", StringType()) \
@@ -227,63 +515,177 @@ def save_lookups(spark, dfReadyForModel, s3_header_path):
     dfLookup = spark.createDataFrame(lRdd, lookupSchema)
     dfLookup.write.csv(s3_header_path, mode="overwrite")
 
-if __name__ == "__main__":
-    if len(sys.argv) != 7:
-        print("Usage: retrain clickstream_name role_arn image_uri input_bucket output_bucket ref_bucket", file=sys.stderr)
-        exit(-1)
+@contextmanager
+def timed_stage(timings, name):
+    """Time the enclosed block as stage name, adding (name, seconds) to timings."""
+    start = time.time()
+    yield
+    elapsed = time.time() - start
+    timings.append((name, elapsed))
+    print("Stage {0} took {1:.1f}s".format(name, elapsed))
+
+def persist_stage(timings, name, df, storage_level):
+    """Persist df at storage_level and compute it right away, timed as stage name.
+
+    Every later use of df then saves about that much time."""
+    df.persist(storage_level)
+    with timed_stage(timings, name):
+        rows = df.count()
+    print("Persisted {0} rows for stage {1} at {2}".format(rows, name, storage_level))
+
+def print_timings(timings, reuses):
+    """Print the time of each stage, and the recomputation avoided by persisting.
+
+    reuses maps a persisted stage to the names of the later stages that read it."""
+    print("Stage timings:")
+    for name, elapsed in timings:
+        print("  {0}: {1:.1f}s".format(name, elapsed))
+    print("  total: {0:.1f}s".format(sum(elapsed for name, elapsed in timings)))
+    stage_times = dict(timings)
+    for name, readers in reuses.items():
+        if name in stage_times and len(readers) > 0:
+            print("Persisting {0} saved about {1:.1f}s by not recomputing it for {2}".format(
+                name, stage_times[name] * len(readers), ", ".join(readers)))
 
-    s3_input_bucket = sys.argv[4]
-    s3_output_bucket = sys.argv[5]
-    s3_ref_bucket = sys.argv[6]
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="retrain")
+    parser.add_argument("clickstream_name")
+    parser.add_argument("role_arn")
+    parser.add_argument("image_uri")
+    parser.add_argument("input_bucket")
+    parser.add_argument("output_bucket")
+    parser.add_argument("ref_bucket")
+    parser.add_argument("--mode", choices=["retrain", "compact"], default="retrain",
+                        help="retrain the model, or only compact the merged click data")
+    parser.add_argument("--codec", default="snappy",
+                        help="parquet compression codec for the merged click data")
+    parser.add_argument("--target-file-mb", type=int, default=128,
+                        help="size of the files compaction aims for")
+    parser.add_argument("--window-days", type=int, default=None,
+                        help="train on the clicks of the last this many days rather than all of them")
+    parser.add_argument("--storage-level", default="MEMORY_AND_DISK",
+                        choices=["MEMORY_ONLY", "MEMORY_ONLY_2", "MEMORY_AND_DISK", "MEMORY_AND_DISK_2",
+                                 "DISK_ONLY", "DISK_ONLY_2", "OFF_HEAP"],
+                        help="Spark storage level for the datasets reused between stages")
+    parser.add_argument("--checkpoint-path", default=None,
+                        help="also save the encoded features here until the run succeeds, so a failed run can resume from them")
+    parser.add_argument("--resume", action="store_true",
+                        help="start from the encoded features in --checkpoint-path, if they are there")
+    args = parser.parse_args()
+    storage_level = getattr(StorageLevel, args.storage_level)
+
+    s3_input_bucket = args.input_bucket
+    s3_output_bucket = args.output_bucket
+    s3_ref_bucket = args.ref_bucket
     header_file_bucket = s3_input_bucket 
     header_file_prefix = "headers/headers.csv" 
     s3_path = "s3://{0}/ddb-out".format(s3_ref_bucket) 
     s3_merged_path = "s3://{0}/merged.parquet".format(s3_input_bucket) 
+    s3_history_path = "s3://{0}/clicks-by-hour.parquet".format(s3_input_bucket) 
+    s3_manifest_path = "s3://{0}/ingest-manifest.parquet".format(s3_input_bucket) 
+    s3_compaction_log_path = "s3://{0}/merged-compaction-log.parquet".format(s3_input_bucket) 
     s3_header_path = "s3://{0}/{1}".format(header_file_bucket, header_file_prefix) 
+    s3_vocab_path = "s3://{0}/headers/vocab".format(header_file_bucket) 
     s3_metrics_path = "s3://{0}/metrics".format(s3_output_bucket) 
     s3_endpoint_path = "s3://{0}/endpoint".format(s3_output_bucket) 
-    roleArn = sys.argv[2] 
-    image_uri = sys.argv[3] 
+    roleArn = args.role_arn 
+    image_uri = args.image_uri 
     train_instance_type = "ml.c4.8xlarge"
     endpoint_instance_type = "ml.m4.xlarge"
-    clickstream_name = sys.argv[1] 
+    clickstream_name = args.clickstream_name 
 
     sc = SparkContext(appName="AdRecRetrain")
     spark = SparkSession.builder.getOrCreate()
 
-    # read the input list of unprocessed partitions 
-    print("Reading input list of files")
-    dfPartitions = read_unprocessed_partitions(spark, s3_path)
-
-    # retain only unprocessed partitions
-    clicksDfPartition = dfPartitions.filter(dfPartitions.processed == '0')
-
-    # load the actual click data
-    print("Loading data")
-    clicksDf = read_click_partitions(spark, clicksDfPartition)
-
-    # drop timestamp
-    prunedClicks = clicksDf.drop('timestamp')
-
-    # write merged data
-    print("Writing parquet data")
-    prunedClicks.write \
-        .format("parquet") \
-        .mode("append") \
-        .option("compression", "gzip") \
-        .save(s3_merged_path)
-    
-    # read full data set
-    print("Reading full parquet data")
-    dfFull = spark.read.parquet(s3_merged_path)
-
-    # one hot encode
-    print("Encoding")
-    dfEncoded = one_hot_encode(dfFull)
-
-    # transform into feature vector for ML
-    print("Preparing features")
-    dfReadyForModel = prepare_features(dfEncoded)
+    if args.mode == "compact":
+        print("Compacting merged data")
+        for path in [s3_history_path, s3_merged_path]:
+            compact_dataset(spark, path, s3_compaction_log_path, args.target_file_mb * 1024 * 1024, args.codec)
+        print("Done")
+        sc.stop()
+        sys.exit(0)
+
+    timings = []
+    reuses = {}
+    dfReadyForModel = None
+    if args.resume and args.checkpoint_path is not None:
+        try:
+            dfReadyForModel = spark.read.parquet(args.checkpoint_path)
+            print("Resuming from the encoded features in {0}, skipping ingest and encoding".format(args.checkpoint_path))
+        except AnalysisException:
+            print("No encoded features in {0}, starting from the beginning".format(args.checkpoint_path))
+
+    if dfReadyForModel is None:
+        # read the input list of unprocessed partitions 
+        print("Reading input list of files")
+        dfPartitions = read_unprocessed_partitions(spark, s3_path)
+
+        # retain only unprocessed partitions
+        clicksDfPartition = dfPartitions.filter(dfPartitions.processed == '0')
+
+        # skip files an earlier run already ingested
+        dfManifest = read_ingest_manifest(spark, s3_manifest_path)
+        files = select_new_files(clicksDfPartition, dfManifest)
+        ingest_batch = "{0}-{1}".format(int(time.time()), uuid.uuid4().hex)
+
+        # load the actual click data, tagged with this run's batch.  It's written to
+        # the history and then scanned for new vocabulary, so keep it.
+        print("Loading data")
+        clicksDf = read_click_partitions(spark, files)
+
+        # partition by the hour the clicks arrived in
+        prunedClicks = with_click_hour(clicksDf).withColumn("ingest_batch", F.lit(ingest_batch))
+        persist_stage(timings, "load", prunedClicks, storage_level)
+        reuses["load"] = ["vocabulary", "ingest"]
+
+        # add this run's new values to the vocabularies before committing the batch, so
+        # every committed value is in them.  A first fit covers all committed history,
+        # whatever the window, as well as this batch.
+        def read_vocabulary_source():
+            dfNew = prunedClicks.select(*feature_columns)
+            try:
+                dfHistory = read_click_history(spark, s3_history_path, s3_merged_path, s3_manifest_path, None)
+            except ValueError:
+                return dfNew.fillna('0')
+            return dfHistory.select(*feature_columns).union(dfNew).fillna('0')
+
+        print("Updating vocabularies")
+        with timed_stage(timings, "vocabulary"):
+            vocabs = update_vocabularies(spark, prunedClicks.fillna('0'), read_vocabulary_source, s3_vocab_path)
+
+        if len(files) > 0:
+            # write merged data
+            print("Writing parquet data for ingest batch {0}".format(ingest_batch))
+            with timed_stage(timings, "ingest"):
+                prunedClicks.write \
+                    .format("parquet") \
+                    .mode("append") \
+                    .partitionBy(*hour_columns) \
+                    .option("compression", args.codec) \
+                    .save(s3_history_path)
+
+                # only now do readers see the new rows
+                commit_ingest(spark, files, ingest_batch, s3_manifest_path)
+            print("Committed {0} files in ingest batch {1}".format(len(files), ingest_batch))
+        else:
+            print("No new files to ingest")
+        
+        # read the data set we train on
+        print("Reading full parquet data")
+        dfFull = read_click_history(spark, s3_history_path, s3_merged_path, s3_manifest_path, args.window_days)
+
+        # one hot encode into a feature vector for ML
+        print("Encoding")
+        dfReadyForModel = encode_features(dfFull, vocabs)
+        persist_stage(timings, "encode", dfReadyForModel, storage_level)
+        prunedClicks.unpersist()
+
+        if args.checkpoint_path is not None:
+            print("Saving encoded features to {0}".format(args.checkpoint_path))
+            with timed_stage(timings, "checkpoint"):
+                dfReadyForModel.write.parquet(args.checkpoint_path, mode="overwrite")
+    else:
+        persist_stage(timings, "resume", dfReadyForModel, storage_level)
 
     # save lookup table
     print("Saving lookup table")
@@ -292,9 +694,23 @@ if __name__ == "__main__":
     # train model
     print("Training model")
     train_df, test_df = dfReadyForModel.randomSplit([0.8, 0.2])
-    model = train_tffm(roleArn, image_uri, header_file_bucket, header_file_prefix, train_instance_type, endpoint_instance_type, train_df)
+    with timed_stage(timings, "training"):
+        model = train_tffm(roleArn, image_uri, header_file_bucket, header_file_prefix, train_instance_type, endpoint_instance_type, train_df)
     print("Validating model")
-    validate_tffm(spark, sc, model, test_df, s3_metrics_path, s3_endpoint_path)
+    with timed_stage(timings, "validation"):
+        validate_tffm(spark, sc, model, test_df, s3_metrics_path, s3_endpoint_path)
+    dfReadyForModel.unpersist()
+
+    # the run succeeded, so a later --resume must not train on these features again
+    if args.checkpoint_path is not None:
+        checkpoint = sc._jvm.org.apache.hadoop.fs.Path(args.checkpoint_path)
+        checkpoint.getFileSystem(sc._jsc.hadoopConfiguration()).delete(checkpoint, True)
+        print("Removed the encoded features in {0}".format(args.checkpoint_path))
+
+    # training and validation each read one split of the encoded features
+    reuses["encode"] = ["training", "validation"]
+    reuses["resume"] = ["training", "validation"]
+    print_timings(timings, reuses)
 
     print("Done")
     sc.stop()
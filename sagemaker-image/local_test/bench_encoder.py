@@ -0,0 +1,140 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Micro-benchmark for the request encoders in tffm/encoder.py.
+#
+# Compares the per-request cost of building the sparse input matrix with the
+# encoder against the list-of-triplets approach the predictor used before, for
+# requests of 20, 200 and 2,000 instances.  Protobuf requests are only timed if
+# the sagemaker module is installed.
+#
+# Usage: python bench_encoder.py [number of users in the headers]
+
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+
+import numpy as np
+import scipy.sparse as sp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tffm'))
+import encoder
+
+try:
+    from sagemaker.amazon.record_pb2 import Record
+except ImportError:
+    Record = None
+
+keys = ["userid", "offerid", "countrycode", "category", "product"]
+sizes = [20, 200, 2000]
+repeats = 20
+
+
+def make_headers(num_users):
+    headers = ["userid_{0:064x}".format(i) for i in range(num_users)]
+    headers.extend("offerid_{0:032x}".format(i) for i in range(20))
+    headers.extend("countrycode_{0}".format(c) for c in ['us', 'gb', 'de', 'fr'])
+    headers.extend("category_{0}".format(i) for i in range(10))
+    headers.extend("product_{0:064x}".format(i) for i in range(20))
+    return headers
+
+
+def make_instances(num_instances, num_users):
+    rng = np.random.RandomState(600)
+    instances = []
+    for i in range(num_instances):
+        instances.append({'keys': keys, 'values': [
+            "{0:064x}".format(rng.randint(num_users)),
+            "{0:032x}".format(i % 20),
+            ['us', 'gb', 'de', 'fr'][rng.randint(4)],
+            str(rng.randint(10)),
+            "{0:064x}".format(rng.randint(20))]})
+    return instances
+
+
+def legacy_instances(instances, index, num_features):
+    te_row_ind = []
+    te_col_ind = []
+    te_data = []
+    te_idx = 0
+    for instance in instances:
+        for key, val in zip(instance['keys'], instance['values']):
+            col = index.get("{0}_{1}".format(key, val), -1)
+            te_row_ind.append(te_idx)
+            te_col_ind.append(col if col >= 0 else 1)
+            te_data.append(1.0 if col >= 0 else 0.0)
+        te_idx = te_idx + 1
+    return sp.csr_matrix((np.array(te_data), (np.array(te_row_ind), np.array(te_col_ind))), shape=(te_idx, num_features))
+
+
+def legacy_records(records, num_features):
+    te_row_ind = []
+    te_col_ind = []
+    te_data = []
+    te_idx = 0
+    for record in records:
+        te_row_ind.extend([te_idx] * len(record.features['values'].float32_tensor.values))
+        te_col_ind.extend(record.features['values'].float32_tensor.keys)
+        te_data.extend(record.features['values'].float32_tensor.values)
+        te_idx = te_idx + 1
+    return sp.csr_matrix((np.array(te_data), (np.array(te_row_ind), np.array(te_col_ind))), shape=(te_idx, num_features))
+
+
+def make_records(X):
+    records = []
+    for row in range(X.shape[0]):
+        record = Record()
+        start, end = X.indptr[row], X.indptr[row + 1]
+        record.features['values'].float32_tensor.keys.extend(X.indices[start:end].tolist())
+        record.features['values'].float32_tensor.values.extend(X.data[start:end].tolist())
+        records.append(record)
+    return records
+
+
+def report(label, num_instances, legacy, vectorized):
+    print("{0:9s} {1:6d} instances: legacy {2:8.3f} ms  encoder {3:8.3f} ms  ({4:.1f}x)".format(
+        label, num_instances, legacy * 1000, vectorized * 1000, legacy / vectorized))
+
+
+def best_of(fn):
+    return min(timeit.repeat(fn, number=1, repeat=repeats))
+
+
+if __name__ == '__main__':
+    num_users = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    headers = make_headers(num_users)
+    num_features = len(headers)
+    index = dict((name, idx) for idx, name in enumerate(headers))
+
+    def lookup_columns(names):
+        return [index.get(name, -1) for name in names]
+
+    print("Header columns: {0}".format(num_features))
+    for num_instances in sizes:
+        instances = make_instances(num_instances, num_users)
+        X = encoder.encode_instances(instances, lookup_columns, num_features)
+        assert (X != legacy_instances(instances, index, num_features)).nnz == 0
+
+        report("JSON", num_instances,
+               best_of(lambda: legacy_instances(instances, index, num_features)),
+               best_of(lambda: encoder.encode_instances(instances, lookup_columns, num_features)))
+
+        if Record is not None:
+            records = make_records(X)
+            report("Protobuf", num_instances,
+                   best_of(lambda: legacy_records(records, num_features)),
+                   best_of(lambda: encoder.encode_records(records, num_features)))
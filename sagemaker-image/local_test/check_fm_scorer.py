@@ -0,0 +1,85 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Checks the NumPy scorer in tffm/fm_scorer.py against TFFM.
+#
+# Trains small TFFM models of order 2 and 3 on random one-hot data, exports them
+# through a saved state file the same way the train script does, and compares the
+# predictions and per-request latency of both.  Needs tensorflow and tffm installed.
+#
+# Usage: python check_fm_scorer.py
+
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+
+import numpy as np
+import scipy.sparse as sp
+import tensorflow as tf
+from tffm import TFFMRegressor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tffm'))
+from fm_scorer import FMScorer
+
+num_features = 5000
+num_samples = 2000
+fields = 5
+
+
+def random_one_hot(rng, num_rows):
+    cols = rng.randint(num_features, size=(num_rows, fields))
+    rows = np.repeat(np.arange(num_rows), fields)
+    return sp.csr_matrix((np.ones(num_rows * fields), (rows, cols.ravel())), shape=(num_rows, num_features))
+
+
+if __name__ == '__main__':
+    rng = np.random.RandomState(600)
+    X = random_one_hot(rng, num_samples)
+    y = rng.randint(2, size=num_samples).astype(np.float32)
+    X_request = random_one_hot(rng, 20)
+    workdir = tempfile.mkdtemp()
+
+    try:
+        for order in [2, 3]:
+            model = TFFMRegressor(
+                order=order,
+                rank=7,
+                optimizer=tf.train.AdamOptimizer(learning_rate=0.1),
+                n_epochs=5,
+                batch_size=-1,
+                init_std=0.001,
+                input_type='sparse'
+            )
+            model.fit(X, y)
+            state = os.path.join(workdir, 'tffm_state_{0}.tf'.format(order))
+            model.save_state(state)
+            scorer = FMScorer.from_checkpoint(state)
+
+            expected = model.predict(X)
+            actual = scorer.predict(X)
+            print("Order {0}: max absolute error {1:.3g}".format(order, np.max(np.abs(expected - actual))))
+            assert np.allclose(expected, actual, rtol=1e-3, atol=1e-4)
+
+            tffm_time = min(timeit.repeat(lambda: model.predict(X_request), number=1, repeat=50))
+            scorer_time = min(timeit.repeat(lambda: scorer.predict(X_request), number=1, repeat=50))
+            print("Order {0}: 20 row request takes {1:.3f} ms in TFFM, {2:.3f} ms in the scorer".format(
+                order, tffm_time * 1000, scorer_time * 1000))
+            model.destroy()
+    finally:
+        shutil.rmtree(workdir)
@@ -0,0 +1,130 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Converts inference requests into the sparse matrices the model scores.
+#
+# Both encoders size the CSR arrays (indptr, indices, data) up front from the
+# request and fill them in a single pass, rather than growing Python lists per
+# feature and letting scipy convert COO triplets.
+
+from __future__ import print_function
+
+import numpy as np
+import scipy.sparse as sp
+
+
+def _to_csr(indptr, indices, data, num_rows, num_features):
+    X = sp.csr_matrix((data, indices, indptr), shape=(num_rows, num_features))
+    # Repeated features within a row are summed, as the COO conversion did.
+    X.sum_duplicates()
+    return X
+
+
+def encode_instances(instances, lookup_columns, num_features):
+    """Encode JSON instances as a CSR matrix with one row per instance.
+
+    Args:
+        instances (list): dicts with parallel 'keys' and 'values' lists. Each pair becomes
+            the one-hot feature "{key}_{value}".
+        lookup_columns (callable): maps a list of feature names to column indices, with -1
+            for names the model doesn't know. Unknown features are left out of the row.
+        num_features (int): number of columns in the model."""
+    num_rows = len(instances)
+    lengths = np.fromiter((len(instance['keys']) for instance in instances), dtype=np.int64, count=num_rows)
+
+    names = ["{0}_{1}".format(key, val)
+             for instance in instances
+             for key, val in zip(instance['keys'], instance['values'])]
+    columns = np.asarray(lookup_columns(names), dtype=np.int64)
+
+    known = columns >= 0
+    if not known.all():
+        rows = np.repeat(np.arange(num_rows), lengths)
+        lengths = np.bincount(rows[known], minlength=num_rows)
+        columns = columns[known]
+
+    indptr = np.zeros(num_rows + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    data = np.ones(len(columns), dtype=np.float32)
+    return _to_csr(indptr, columns, data, num_rows, num_features)
+
+
+def encode_records(records, num_features):
+    """Encode protobuf Records as a CSR matrix with one row per record.
+
+    Args:
+        records (list): sagemaker Record messages with a sparse float32 'values' feature.
+        num_features (int): number of columns in the model."""
+    num_rows = len(records)
+    tensors = [record.features['values'].float32_tensor for record in records]
+
+    indptr = np.zeros(num_rows + 1, dtype=np.int64)
+    np.cumsum(np.fromiter((len(tensor.values) for tensor in tensors), dtype=np.int64, count=num_rows),
+              out=indptr[1:])
+    indices = np.empty(indptr[-1], dtype=np.int64)
+    data = np.empty(indptr[-1], dtype=np.float32)
+    for row, tensor in enumerate(tensors):
+        start, end = indptr[row], indptr[row + 1]
+        indices[start:end] = tensor.keys
+        data[start:end] = tensor.values
+    return _to_csr(indptr, indices, data, num_rows, num_features)
+
+
+def encode_candidates(contexts, candidates, lookup_columns, num_features):
+    """Encode shared contexts scored against a list of candidates.
+
+    Every context is paired with every candidate, giving one row per pair: the rows for
+    the first context against each candidate in order, then the second context, and so
+    on.  Context features are resolved once per context rather than once per row, so a
+    request that scores many offers for a user only carries the user's features once.
+
+    Args:
+        contexts (list): dicts with 'keys' and 'values' lists for the features shared by
+            that context's rows.
+        candidates (dict): 'keys' list naming the per-candidate features, and 'values', a
+            list with one list of values per candidate.
+        lookup_columns (callable): maps a list of feature names to column indices, with -1
+            for names the model doesn't know. Unknown features are left out of the row.
+        num_features (int): number of columns in the model."""
+    # Contexts may have different numbers of features, so their columns are laid out in
+    # a matrix as wide as the longest, padded with -1.
+    num_contexts = len(contexts)
+    context_lengths = np.array([min(len(context['keys']), len(context['values'])) for context in contexts],
+                               dtype=np.int64)
+    context_width = context_lengths.max() if num_contexts > 0 else 0
+    context_names = ["{0}_{1}".format(key, val)
+                     for context in contexts
+                     for key, val in zip(context['keys'], context['values'])]
+    context_columns = np.full((num_contexts, context_width), -1, dtype=np.int64)
+    context_columns[np.arange(context_width) < context_lengths[:, np.newaxis]] = lookup_columns(context_names)
+
+    candidate_keys = candidates['keys']
+    num_candidates = len(candidates['values'])
+    candidate_names = ["{0}_{1}".format(key, val)
+                       for values in candidates['values']
+                       for key, val in zip(candidate_keys, values)]
+    candidate_columns = np.asarray(lookup_columns(candidate_names), dtype=np.int64) \
+        .reshape(num_candidates, len(candidate_keys))
+
+    num_rows = num_contexts * num_candidates
+    columns = np.hstack([np.repeat(context_columns, num_candidates, axis=0),
+                         np.tile(candidate_columns, (num_contexts, 1))])
+    known = columns >= 0
+
+    indptr = np.zeros(num_rows + 1, dtype=np.int64)
+    np.cumsum(known.sum(axis=1), out=indptr[1:])
+    indices = columns[known]
+    data = np.ones(len(indices), dtype=np.float32)
+    return _to_csr(indptr, indices, data, num_rows, num_features)
@@ -0,0 +1,117 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Scores TFFM factorization machines with NumPy and SciPy.
+#
+# TFFM computes a model of order d as
+#
+#   y(x) = b + x.w1 + sum over k=2..d of sum over factors f of e_k(x * V_k[:, f])
+#
+# where e_k is the k-th elementary symmetric polynomial of the per-feature terms.
+# We evaluate e_k from the power sums p_j = (x^j).(V_k^j) with Newton's identities,
+# which is the same closed form TFFM builds into its graph, so the scores match
+# without needing a TensorFlow session per request.
+
+from __future__ import print_function
+
+import os
+
+import numpy as np
+import scipy.sparse as sp
+
+
+class FMScorer(object):
+    """Inference-only factorization machine built from trained TFFM weights."""
+
+    def __init__(self, bias, weights):
+        """
+        Args:
+            bias (float): the global bias.
+            weights (list): one matrix per order. weights[0] is the (num_features, 1) linear
+                weights and weights[k - 1] the (num_features, rank) factors for order k."""
+        self.bias = float(bias)
+        self.weights = weights
+
+    @property
+    def order(self):
+        return len(self.weights)
+
+    @property
+    def num_features(self):
+        return self.weights[0].shape[0]
+
+    @classmethod
+    def from_checkpoint(cls, path):
+        """Read the weights out of a state file written by TFFMRegressor.save_state."""
+        import tensorflow as tf
+
+        reader = tf.train.NewCheckpointReader(path)
+        names = reader.get_variable_to_shape_map().keys()
+
+        def tensor(short_name):
+            # Optimizer slots live under the variable's name (e.g. ".../embedding_1/Adam"),
+            # so only an exact final component identifies the variable itself.
+            matches = [name for name in names if name.split('/')[-1] == short_name]
+            if len(matches) != 1:
+                raise ValueError('Expected one {0} variable in {1}, found {2}'.format(short_name, path, matches))
+            return reader.get_tensor(matches[0])
+
+        order = len([name for name in names if name.split('/')[-1].startswith('embedding_')])
+        weights = [tensor('embedding_{0}'.format(k)) for k in range(1, order + 1)]
+        return cls(tensor('bias'), weights)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Load weights written by save(). The weight matrices are memory-mapped by default,
+        so loading is quick whatever the model size and the pages are shared between
+        processes."""
+        weights = []
+        weights_file = os.path.join(path, 'w1.npy')
+        while os.path.exists(weights_file):
+            weights.append(np.load(weights_file, mmap_mode=mmap_mode))
+            weights_file = os.path.join(path, 'w{0}.npy'.format(len(weights) + 1))
+        return cls(np.load(os.path.join(path, 'bias.npy')), weights)
+
+    def save(self, path):
+        """Write the weights to the directory path, one .npy file per matrix."""
+        if not os.path.exists(path):
+            os.makedirs(path)
+        np.save(os.path.join(path, 'bias.npy'), np.array(self.bias))
+        for k, weights in enumerate(self.weights, 1):
+            np.save(os.path.join(path, 'w{0}.npy'.format(k)), weights)
+
+    def predict(self, X):
+        """Score each row of the sparse matrix X, returning a 1-D array."""
+        X = sp.csr_matrix(X)
+
+        # Only the columns present in this batch contribute, so work on those rows of
+        # the weights rather than raising full weight matrices to powers.
+        columns, local = np.unique(X.indices, return_inverse=True)
+        X = sp.csr_matrix((X.data.astype(np.float64), local, X.indptr), shape=(X.shape[0], len(columns)))
+
+        outputs = self.bias + X.dot(self.weights[0][columns].astype(np.float64)).ravel()
+        for k in range(2, self.order + 1):
+            factors = self.weights[k - 1][columns].astype(np.float64)
+            power_sums = [X.power(j).dot(np.power(factors, j)) for j in range(1, k + 1)]
+
+            # Newton's identities: j * e_j = sum over i=1..j of (-1)^(i-1) * e_(j-i) * p_i
+            elementary = [np.ones_like(power_sums[0])]
+            for j in range(1, k + 1):
+                e_j = np.zeros_like(power_sums[0])
+                for i in range(1, j + 1):
+                    e_j += (-1) ** (i - 1) * elementary[j - i] * power_sums[i - 1]
+                elementary.append(e_j / j)
+            outputs += elementary[k].sum(axis=1)
+        return outputs
@@ -0,0 +1,86 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# A sorted string table mapping feature names to model columns.
+#
+# The names are stored as a sorted fixed-width byte array alongside the column
+# of each name, both as .npy files.  Loading memory-maps them, so startup time
+# doesn't depend on the number of features and the pages are shared between
+# processes.  Lookups are a vectorized binary search.
+
+from __future__ import print_function
+
+import os
+
+import numpy as np
+
+names_file = 'header_names.npy'
+columns_file = 'header_columns.npy'
+
+
+def _to_bytes(name):
+    if isinstance(name, bytes):
+        return name
+    return name.encode('utf-8')
+
+
+class HeaderTable(object):
+    """Maps feature names to column indices."""
+
+    def __init__(self, names, columns):
+        """
+        Args:
+            names (numpy array): feature names as sorted fixed-width bytes.
+            columns (numpy array): the column index of each name."""
+        self.names = names
+        self.columns = columns
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def build(cls, headers):
+        """Build a table from the header list, where a name's position is its column."""
+        names = np.array([_to_bytes(h) for h in headers], dtype=bytes)
+        order = np.argsort(names, kind='mergesort')
+        return cls(names[order], order.astype(np.int64))
+
+    @classmethod
+    def exists(cls, path):
+        return os.path.exists(os.path.join(path, names_file))
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Load a table written by save(), memory-mapped by default."""
+        return cls(np.load(os.path.join(path, names_file), mmap_mode=mmap_mode),
+                   np.load(os.path.join(path, columns_file), mmap_mode=mmap_mode))
+
+    def save(self, path):
+        np.save(os.path.join(path, names_file), self.names)
+        np.save(os.path.join(path, columns_file), self.columns)
+
+    def lookup(self, names):
+        """Return the column of each name as an array, with -1 for names not in the table."""
+        if len(names) == 0 or len(self.names) == 0:
+            return np.full(len(names), -1, dtype=np.int64)
+        keys = np.array([_to_bytes(name) for name in names], dtype=bytes)
+
+        # Names wider than the table can't be in it, and would be truncated by the cast.
+        fits = np.char.str_len(keys) <= self.names.dtype.itemsize
+        keys = keys.astype(self.names.dtype)
+
+        positions = np.minimum(np.searchsorted(self.names, keys), len(self.names) - 1)
+        found = fits & (self.names[positions] == keys)
+        return np.where(found, self.columns[positions], -1)
@@ -13,7 +13,7 @@
 # OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
-# This file implements a SageMaker model predictor using TFFM.
+# This file implements a SageMaker model predictor for models trained with TFFM.
 # As input, it expects either JSON or Protobuf.  
 # It returns predictions in the same format as the input.
 
@@ -22,6 +22,7 @@ from __future__ import print_function
 import os
 import io
 import json
+import numbers
 import pickle
 import StringIO
 import sys
@@ -32,14 +33,16 @@ import traceback
 import flask
 
 import pandas as pd
-import tensorflow as tf
-from tffm import TFFMRegressor
 import numpy as np
 import scipy.sparse as sp
 
 import sagemaker.amazon.common as smac
 from sagemaker.amazon.record_pb2 import Record
 
+import encoder
+from fm_scorer import FMScorer
+from header_table import HeaderTable
+
 prefix = '/opt/ml/'
 model_path = os.path.join(prefix, 'model')
 
@@ -50,6 +53,8 @@ class ScoringService(object):
     model = None                # Where we keep the model when it's loaded
     num_features = 0
     headers = None
+    header_index = None         # HeaderTable mapping "{key}_{value}" feature names to column indices
+    unknown_features = 0        # Number of lookups that missed the header index
 
     @classmethod
     def get_headers(cls):
@@ -58,30 +63,67 @@ class ScoringService(object):
                 cls.headers = [x.strip() for x in inp.readlines()]
         return cls.headers
 
+    @classmethod
+    def get_header_index(cls):
+        """Get the feature name to column index table.
+
+        Models trained with the header table artifact have it memory-mapped; for older
+        models it's built from headers.csv."""
+        if cls.header_index == None:
+            if HeaderTable.exists(model_path):
+                cls.header_index = HeaderTable.load(model_path)
+            else:
+                cls.header_index = HeaderTable.build(cls.get_headers())
+        return cls.header_index
+
+    @classmethod
+    def lookup_columns(cls, names):
+        """Resolve feature names to column indices, using -1 for names not in the headers.
+
+        Misses are counted rather than logged individually; a single summary line is
+        printed per call that had any."""
+        columns = cls.get_header_index().lookup(names)
+        misses = int((columns < 0).sum())
+        if misses > 0:
+            cls.unknown_features = cls.unknown_features + misses
+            print("Couldn't find headers for {0} of {1} features ({2} since startup)".format(
+                misses, len(names), cls.unknown_features))
+        return columns
+
     @classmethod
     def get_num_features(cls):
         if cls.num_features == 0:
-            cls.num_features = len(cls.get_headers())
+            cls.num_features = len(cls.get_header_index())
         return cls.num_features
 
     @classmethod
     def get_model(cls):
-        """Get the model object for this instance, loading it if it's not already loaded."""
+        """Get the model object for this instance, loading it if it's not already loaded.
+
+        Models trained before the weights were exported alongside the TFFM state are read
+        from the TensorFlow checkpoint instead."""
         if cls.model == None:
-            cls.model = TFFMRegressor(
-                 order=3,
-                 rank=7,
-                 optimizer=tf.train.AdamOptimizer(learning_rate=0.1),
-                 n_epochs=50,
-                 batch_size=-1,
-                 init_std=0.001,
-                 input_type='sparse'
-             )
-            cls.model.core.set_num_features(cls.get_num_features())
-            cls.model.load_state(os.path.join(model_path, 'tffm_state.tf'))
-            
+            fm_path = os.path.join(model_path, 'fm_model')
+            if os.path.exists(fm_path):
+                cls.model = FMScorer.load(fm_path)
+            else:
+                cls.model = FMScorer.from_checkpoint(os.path.join(model_path, 'tffm_state.tf'))
+
         return cls.model
 
+    @classmethod
+    def load(cls):
+        """Load the model and header index up front rather than on the first request.
+
+        The weights are made read-only so nothing can write to them; when this runs before
+        gunicorn forks its workers, their pages then stay shared between the processes."""
+        model = cls.get_model()
+        for weights in model.weights:
+            weights.setflags(write=False)
+        cls.get_header_index()
+        cls.get_num_features()
+        print('Loaded order {0} model with {1} features'.format(model.order, model.num_features))
+
     @classmethod
     def predict(cls, input):
         """For the input, do the predictions and return them.
@@ -92,6 +134,23 @@ class ScoringService(object):
         clf = cls.get_model()
         return clf.predict(input)
 
+def select_top_k(scores, k):
+    """Return the indices of the k highest scores, best first.
+
+    Uses a partial sort, so picking a few offers out of thousands of candidates doesn't
+    pay for sorting all of them."""
+    k = min(k, len(scores))
+    if k == 0:
+        return np.array([], dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top], kind='mergesort')]
+
+def format_predictions(scores, top_k):
+    """Convert an array of scores to the JSON predictions list."""
+    if top_k is None:
+        return [{'score': str(pred_value)} for pred_value in scores]
+    return [{'index': int(row), 'score': float(scores[row])} for row in select_top_k(scores, top_k)]
+
 # The flask app for serving predictions
 app = flask.Flask(__name__)
 
@@ -111,52 +170,46 @@ def transformation():
 
     Input format is:
     '{"instances": [{"keys": ["User","1","2"], "values": ["a","b","c"]}, {"keys": ["User","5","6"], "values": ["d","e","f"]}]}' 
+
+    To score several candidates against the same features, send the shared features once as
+    the context and only the varying features per candidate:
+    '{"context": {"keys": ["User","1"], "values": ["a","b"]}, "candidates": {"keys": ["2"], "values": [["c"], ["f"]]}}'
+    There is one prediction per candidate, in the order given.
+
+    Several contexts can be scored against the same candidates in one request by sending
+    "contexts", a list of contexts, in place of "context".  The response then has one entry
+    per context, each holding that context's predictions:
+    '{"results": [{"predictions": [...]}, {"predictions": [...]}]}'
+
+    Adding "top_k": k to a JSON request returns only the k best scoring rows, best first, as
+    '{"predictions": [{"index": 3, "score": 0.92}, ...]}' where index is the row's position
+    in the request.  With "contexts", that's the k best candidates for each context.
     """
 
-    # Convert from json to numpy
-    te_row_ind = []
-    te_col_ind = []
-    te_data = []
-    te_idx = 0
-    headers = ScoringService.get_headers()
+    # Convert from json or protobuf to a sparse matrix
+    num_features = ScoringService.get_num_features()
     if flask.request.content_type == 'application/json':
         print("Working with JSON input")
         s = flask.request.data.decode('utf-8')
         inputs = json.loads(s)
-        for instance in inputs['instances']:
-
-            # The column index has to be found from the headers
-            for col_idx in range(0, len(instance['keys'])):
-                key = instance['keys'][col_idx]
-                val = instance['values'][col_idx]
-                item_to_find = "{0}_{1}".format(key, val)
-                try:
-                    te_col_ind.append(headers.index(item_to_find))
-                    te_data.append(1.0)
-                    te_row_ind.append(te_idx) 
-                except Exception as e:
-                    te_col_ind.append(1)
-                    te_data.append(0.0)
-                    te_row_ind.append(te_idx) 
-                    print("Couldn't find header for {0}".format(item_to_find))
-            te_idx = te_idx + 1
+        top_k = inputs.get('top_k')
+        if top_k is not None and (isinstance(top_k, bool) or not isinstance(top_k, numbers.Integral) or top_k < 1):
+            return flask.Response(response='top_k must be a positive integer', status=400, mimetype='text/plain')
+        contexts = inputs.get('contexts')
+        if 'context' in inputs:
+            contexts = [inputs['context']]
+        if contexts is not None:
+            X_te_sparse = encoder.encode_candidates(contexts, inputs['candidates'],
+                                                    ScoringService.lookup_columns, num_features)
+        else:
+            X_te_sparse = encoder.encode_instances(inputs['instances'], ScoringService.lookup_columns, num_features)
     elif flask.request.content_type == 'application/x-recordio-protobuf':
         print("Working with Protobuf input")
-        #print("{0}".format(flask.request.stream))
-        #s = flask.request.data.decode('latin-1')
-        #print("Data: {}".format(s))
         test_records = smac.read_records(StringIO.StringIO(flask.request.data))
-        num_test_samples = len(test_records)
-        for test_record in test_records:
-            te_row_ind.extend([te_idx] * len(test_record.features['values'].float32_tensor.values))
-            te_col_ind.extend(test_record.features['values'].float32_tensor.keys)
-            te_data.extend(test_record.features['values'].float32_tensor.values)
-            te_idx = te_idx + 1
-
+        X_te_sparse = encoder.encode_records(test_records, num_features)
     else:
         return flask.Response(response='This predictor only supports JSON or Protobuf data', status=415, mimetype='text/plain')
 
-    X_te_sparse = sp.csr_matrix( (np.array(te_data),(np.array(te_row_ind),np.array(te_col_ind))), shape=(te_idx,ScoringService.get_num_features()) )
     print('Invoked with {} records'.format(X_te_sparse.shape))
 
     # Do the prediction
@@ -165,9 +218,13 @@ def transformation():
     # Convert from array back to json
     result = None
     if flask.request.content_type == 'application/json':
-        js = {'predictions': []}
-        for pred_value in predictions:
-            js['predictions'].append({'score': str(pred_value)})
+        scores = np.ravel(predictions)
+        if 'contexts' in inputs:
+            js = {'results': []}
+            for context_scores in scores.reshape(len(contexts), len(inputs['candidates']['values'])):
+                js['results'].append({'predictions': format_predictions(context_scores, top_k)})
+        else:
+            js = {'predictions': format_predictions(scores, top_k)}
         result = json.dumps(js)
     else:
         # convert to protobuf
@@ -0,0 +1,184 @@
+# Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Streaming reader for the sparse protobuf RecordIO files SageMaker feeds to training.
+#
+# sagemaker.amazon.common.read_records parses a whole file into a list of Record
+# messages.  Here records are parsed one frame at a time and copied straight into
+# CSR buffers that grow geometrically, so peak memory stays close to the size of
+# the sparse matrix being built.
+
+from __future__ import print_function
+
+import collections
+import io
+import multiprocessing
+import struct
+
+import numpy as np
+import scipy.sparse as sp
+
+from sagemaker.amazon.record_pb2 import Record
+
+# RecordIO frame header: a magic number, then the payload length in the low 29 bits
+_kmagic = 0xced7230a
+_length_mask = (1 << 29) - 1
+_header = struct.Struct('<II')
+
+# Initial sizes of the CSR buffers, which double whenever they fill up
+initial_rows = 1 << 16
+initial_nonzeros = 1 << 20
+
+
+def iter_records(stream):
+    """Yield the Record messages in a RecordIO stream one at a time.
+
+    The same Record object is reused for every frame, so callers must copy out what
+    they need before asking for the next one."""
+    record = Record()
+    while True:
+        header = stream.read(_header.size)
+        if len(header) < _header.size:
+            return
+        magic, length = _header.unpack(header)
+        if magic != _kmagic:
+            raise ValueError('Invalid RecordIO magic number {0:#x}'.format(magic))
+        length = length & _length_mask
+        record.ParseFromString(stream.read(length))
+        padding = ((length + 3) >> 2 << 2) - length
+        if padding:
+            stream.read(padding)
+        yield record
+
+
+class SparseBuilder(object):
+    """Accumulates labelled sparse records into CSR buffers."""
+
+    def __init__(self, num_features, rows=initial_rows, nonzeros=initial_nonzeros):
+        self.num_features = num_features
+        self.num_rows = 0
+        self.indptr = np.zeros(rows + 1, dtype=np.int64)
+        self.indices = np.empty(nonzeros, dtype=np.int32 if num_features <= np.iinfo(np.int32).max else np.int64)
+        self.data = np.empty(nonzeros, dtype=np.float32)
+        self.labels = np.empty(rows, dtype=np.float32)
+
+    def _reserve(self, rows, nonzeros):
+        """Make room for at least rows rows and nonzeros nonzeros in total."""
+        if rows > len(self.labels):
+            rows = max(rows, 2 * len(self.labels))
+            self.indptr.resize(rows + 1, refcheck=False)
+            self.labels.resize(rows, refcheck=False)
+        if nonzeros > len(self.data):
+            nonzeros = max(nonzeros, 2 * len(self.data))
+            self.indices.resize(nonzeros, refcheck=False)
+            self.data.resize(nonzeros, refcheck=False)
+
+    def append(self, record):
+        """Copy the features and label of a Record into the buffers."""
+        tensor = record.features['values'].float32_tensor
+        start = self.indptr[self.num_rows]
+        end = start + len(tensor.values)
+        self._reserve(self.num_rows + 1, end)
+
+        self.indices[start:end] = tensor.keys
+        self.data[start:end] = tensor.values
+        self.labels[self.num_rows] = record.label['values'].float32_tensor.values[0]
+        self.num_rows = self.num_rows + 1
+        self.indptr[self.num_rows] = end
+
+    def extend(self, X, y):
+        """Copy the rows of a CSR matrix and their labels into the buffers."""
+        start = self.indptr[self.num_rows]
+        end = start + X.nnz
+        rows = self.num_rows + X.shape[0]
+        self._reserve(rows, end)
+
+        self.indices[start:end] = X.indices
+        self.data[start:end] = X.data
+        self.labels[self.num_rows:rows] = y
+        self.indptr[self.num_rows + 1:rows + 1] = X.indptr[1:] + start
+        self.num_rows = rows
+
+    def build(self):
+        """Trim the buffers and return the records read as (CSR matrix, label array)."""
+        nonzeros = self.indptr[self.num_rows]
+        self.indptr.resize(self.num_rows + 1, refcheck=False)
+        self.labels.resize(self.num_rows, refcheck=False)
+        self.indices.resize(nonzeros, refcheck=False)
+        self.data.resize(nonzeros, refcheck=False)
+
+        # scipy wants indptr and indices to share a dtype, and would copy both otherwise
+        indptr = self.indptr
+        if self.indices.dtype == np.int32 and nonzeros <= np.iinfo(np.int32).max:
+            indptr = indptr.astype(np.int32)
+        X = sp.csr_matrix((self.data, self.indices, indptr), shape=(self.num_rows, self.num_features), copy=False)
+        return X, self.labels
+
+
+def read_sparse(paths, num_features):
+    """Read every record in the RecordIO files at paths into a CSR matrix and label array."""
+    builder = SparseBuilder(num_features)
+    for path in paths:
+        with io.open(path, 'rb') as stream:
+            for record in iter_records(stream):
+                builder.append(record)
+    return builder.build()
+
+
+def iter_sparse_chunks(paths, num_features, chunk_rows):
+    """Read the RecordIO files at paths in order, yielding (CSR matrix, label array) blocks
+    of chunk_rows rows (the last may be shorter), so only one block is in memory at a time."""
+    builder = SparseBuilder(num_features, rows=chunk_rows)
+    for path in paths:
+        with io.open(path, 'rb') as stream:
+            for record in iter_records(stream):
+                builder.append(record)
+                if builder.num_rows == chunk_rows:
+                    yield builder.build()
+                    builder = SparseBuilder(num_features, rows=chunk_rows)
+    if builder.num_rows > 0:
+        yield builder.build()
+
+
+def _read_file(args):
+    path, num_features = args
+    return read_sparse([path], num_features)
+
+
+def read_sparse_parallel(paths, num_features, workers):
+    """Like read_sparse, but parse the files in a pool of worker processes.
+
+    Each worker returns the CSR block for one file, and the blocks are copied into the
+    final buffers in file order.  At most two files per worker are submitted ahead of
+    the block being copied, so only a few blocks are held at once however fast the
+    workers parse."""
+    workers = min(workers, len(paths))
+    if workers <= 1:
+        return read_sparse(paths, num_features)
+
+    builder = SparseBuilder(num_features)
+    pool = multiprocessing.Pool(workers)
+    try:
+        pending = collections.deque()
+        for path in paths:
+            if len(pending) == 2 * workers:
+                builder.extend(*pending.popleft().get())
+            pending.append(pool.apply_async(_read_file, [(path, num_features)]))
+        while len(pending) > 0:
+            builder.extend(*pending.popleft().get())
+    finally:
+        pool.close()
+        pool.join()
+    return builder.build()
@@ -20,3 +20,7 @@ import predictor as myapp
 # new file.
 
 app = myapp.app
+
+# Load the model when the app is imported, so workers are warm before their first request.
+# When gunicorn runs with --preload this happens once in the master, before the fork.
+myapp.ScoringService.load()
@@ -90,12 +90,17 @@ timestamp = fields[5]
 rating = fields[6]
 uid = base64.b64encode(user)
 
-# Convert to json
-js = {'instances': []}
+# Convert to json.  The user's features are sent once as the context, and
+# each offer we want scored is a candidate.  We only need the best offer back.
+js = {
+    'context': {'keys': ["userid","countrycode","category","product"], 'values': [uid,countrycode,category,product]},
+    'candidates': {'keys': ["offerid"], 'values': []},
+    'top_k': 1
+}
 ad_idx = {}
 idx = 0
 for adkey in ad_map.keys():
-    js['instances'].append({'keys': ["userid","offerid","countrycode","category","product"], 'values': [uid,adkey,countrycode,category,product]})
+    js['candidates']['values'].append([adkey])
     ad_idx[str(idx)] = adkey
     idx = idx + 1
 model_input = json.dumps(js)
@@ -113,15 +118,9 @@ response = client.invoke_endpoint(
 res_json = json.loads(response['Body'].read().decode("utf-8"))
 
 print("Got model response {0}".format(res_json))
-idx = 0
-max_score = -2.0
-selected_ad = '0'
-for prediction in res_json['predictions']:
-    score = prediction['score']
-    if score > max_score:
-        max_score = score
-        selected_ad = ad_idx[str(idx)]
-    idx = idx + 1
+best = res_json['predictions'][0]
+max_score = best['score']
+selected_ad = ad_idx[str(best['index'])]
 
 print("Best response score: {0}".format(max_score))
 print("Best ad: {0}".format(selected_ad))